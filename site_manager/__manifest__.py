@@ -12,6 +12,13 @@
         "views/site_views.xml",
         "views/requirement_views.xml",
         "views/project_site_views.xml",
+        "views/invoicing_job_views.xml",
+        "views/invoicing_run_views.xml",
+        "views/site_import_views.xml",
+        "views/timesheet_summary_views.xml",
+        "views/portfolio_summary_views.xml",
+        "views/metrics_views.xml",
+        "data/ir_cron.xml",
     ],
     "installable": True,
     "application": False,
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+from odoo import http
+from odoo.http import request
+
+
+class SiteManagerController(http.Controller):
+
+    @http.route('/site_manager/validate_transitions', type='json', auth='user')
+    def validate_transitions(self, transitions, **kwargs):
+        """Dry-run validation of [site_id, stage_id] pairs, see project.project.validate_stage_transitions."""
+        return request.env['project.project'].validate_stage_transitions(transitions)
@@ -1,3 +1,14 @@
+from . import metrics
+from . import batch_job
 from . import project_inherit
 from . import requirement
-from . import study_case
\ No newline at end of file
+from . import stage_readiness
+from . import timesheet_summary
+from . import study_case
+from . import invoicing_job
+from . import invoicing_run
+from . import site_import
+from . import deadline_escalation
+from . import portfolio_summary
+# keep last: wraps every other project.project write override
+from . import project_metrics
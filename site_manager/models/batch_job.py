@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from odoo import api, models, _
+from odoo.exceptions import UserError
+
+
+class SiteBatchJobMixin(models.AbstractModel):
+    """Long work committed batch by batch, so an interrupted run resumes where it stopped.
+
+    Job models have a ``state`` field (queued, running, done, failed) and
+    implement ``_run()``.
+    """
+    _name = "site.batch.job.mixin"
+    _description = "Site Batch Job Mixin"
+
+    @api.model
+    def _cron_run_jobs(self):
+        """Run (or resume) every queued or interrupted job."""
+        for job in self.search([('state', 'in', ('queued', 'running'))], order='id'):
+            job._run()
+
+    def action_run(self):
+        for job in self:
+            if job.state == 'done':
+                raise UserError(_("Job %s is already done.") % job.name)
+            job.state = 'queued'
+            job._run()
+        return True
+
+    def _commit(self):
+        # batches are committed one by one, except in tests
+        if not getattr(threading.current_thread(), 'testing', False):
+            self.env.cr.commit()
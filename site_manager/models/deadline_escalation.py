@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+import logging
+from datetime import datetime, timedelta
+
+from odoo import api, fields, models, _
+
+_logger = logging.getLogger(__name__)
+
+ESCALATION_LEVELS = [
+    ('near', 'Near Deadline'),
+    ('overdue', 'Overdue'),
+]
+# default lead time of the 'near' level per project size, in days
+NEAR_LEAD_DAYS = {'small': 7, 'medium': 14, 'large': 30, False: 7}
+# a new watermark starts before every deadline, so the backlog is escalated too
+BACKLOG_START = datetime(1970, 1, 1)
+
+
+class SiteDeadlineWatermark(models.Model):
+    """Last (deadline_date, id) escalated per level and project size.
+
+    A site crosses a level when ``deadline_date - lead time`` passes, so
+    each run only walks the deadlines between the watermark and
+    ``now + lead time`` on the (project_size, deadline_date, id) index.
+    Sites on a closed milestone are not walked: the watermark only passes
+    escalated sites, the others are escalated when they leave the milestone.
+    """
+    _name = "site.deadline.watermark"
+    _inherit = "site.batch.job.mixin"
+    _description = "Site Deadline Escalation Watermark"
+    _order = "level, project_size"
+
+    level = fields.Selection(ESCALATION_LEVELS, string="Level", required=True)
+    project_size = fields.Char(string="Project Size")
+    last_deadline = fields.Datetime(string="Last Deadline", required=True)
+    last_project_id = fields.Integer(string="Last Site")
+
+    _sql_constraints = [
+        ('level_size_uniq', 'unique (level, project_size)', 'One watermark per level and project size.'),
+    ]
+
+    @api.model
+    def _get_lead_time(self, level, project_size):
+        if level == 'overdue':
+            return timedelta(0)
+        days = self.env['ir.config_parameter'].sudo().get_param(
+            'site_manager.deadline_near_days_%s' % (project_size or 'none'), NEAR_LEAD_DAYS.get(project_size, 7))
+        return timedelta(days=int(days))
+
+    @api.model
+    def _get_watermark(self, level, project_size):
+        """Watermark of (level, size); a new one starts before the backlog, which the batches then work through."""
+        watermark = self.search([('level', '=', level), ('project_size', '=', project_size or False)], limit=1)
+        if not watermark:
+            watermark = self.create({
+                'level': level,
+                'project_size': project_size or False,
+                'last_deadline': BACKLOG_START,
+                'last_project_id': 0,
+            })
+        return watermark
+
+    @api.model
+    def _cron_escalate_deadlines(self, now=None):
+        """Escalate the sites whose deadline crossed a level since the last run, one committed batch at a time."""
+        now = now or fields.Datetime.now()
+        batch_size = int(self.env['ir.config_parameter'].sudo().get_param('site_manager.deadline_batch_size', 1000))
+        Project = self.env['project.project']
+        sizes = [False] + [key for key, dummy in Project._fields['project_size'].selection]
+        # 'near' first, a site crossing both levels in one run ends overdue
+        for level, dummy in ESCALATION_LEVELS:
+            for project_size in sizes:
+                watermark = self._get_watermark(level, project_size)
+                until = now + self._get_lead_time(level, project_size)
+                while True:
+                    sql, params = Project._get_deadline_crossing_query(
+                        project_size, watermark.last_deadline, watermark.last_project_id, until, batch_size)
+                    self.env.cr.execute(sql, params)
+                    rows = self.env.cr.fetchall()
+                    if not rows:
+                        break
+                    Project.browse([row[0] for row in rows])._escalate_deadline(level, now)
+                    watermark.write({'last_project_id': rows[-1][0], 'last_deadline': rows[-1][1]})
+                    self._commit()
+                    _logger.info("Deadline escalation %s/%s: %s sites", level, project_size or 'none', len(rows))
+                    if len(rows) < batch_size:
+                        break
+                    # drop what the batch loaded, memory stays bounded by the batch size
+                    self.env.invalidate_all()
+
+
+class ProjectProject(models.Model):
+    _inherit = "project.project"
+
+    deadline_escalation = fields.Selection(ESCALATION_LEVELS, string="Deadline Escalation", readonly=True, copy=False)
+
+    @api.model
+    def _get_deadline_crossing_query(self, project_size, after_deadline, after_id, until, limit):
+        """Sites of a project size with a deadline in ]watermark, until], in keyset order.
+
+        Sites on a closed (folded) milestone are left out, see _check_deadline_escalation.
+        """
+        size_condition = "p.project_size = %s" if project_size else "p.project_size IS NULL"
+        sql = """
+            SELECT p.id, p.deadline_date
+            FROM project_project p
+            LEFT JOIN project_task milestone ON milestone.id = p.stage_site_id
+            LEFT JOIN project_task_type milestone_stage ON milestone_stage.id = milestone.stage_id
+            WHERE {size_condition}
+              AND p.deadline_date IS NOT NULL
+              AND (p.deadline_date, p.id) > (%s, %s)
+              AND p.deadline_date <= %s
+              AND p.active
+              AND milestone_stage.fold IS NOT TRUE
+            ORDER BY p.deadline_date, p.id
+            LIMIT %s
+        """.format(size_condition=size_condition)
+        params = ([project_size] if project_size else []) + [after_deadline, after_id, until, limit]
+        return sql, params
+
+    def _get_deadline_level(self, now):
+        """Level reached by the deadline of the site at ``now`` (or False)."""
+        self.ensure_one()
+        if not self.deadline_date:
+            return False
+        Watermark = self.env['site.deadline.watermark']
+        if self.deadline_date <= now:
+            return 'overdue'
+        if self.deadline_date <= now + Watermark._get_lead_time('near', self.project_size):
+            return 'near'
+        return False
+
+    def _escalate_deadline(self, level, now):
+        """Schedule the escalation activity of ``level`` on the sites that have not reached it yet.
+
+        Sites on a closed milestone are skipped, and so are the sites already
+        past ``level`` at ``now`` (a backlog walked by the 'near' pass), which
+        the next level escalates directly. Sites above the high budget
+        threshold get an activity due today instead of on their deadline.
+        """
+        levels = [False] + [key for key, dummy in ESCALATION_LEVELS]
+        high_budget = float(self.env['ir.config_parameter'].sudo().get_param('site_manager.deadline_high_budget', 100000))
+        sites = self.filtered(lambda site: (
+            levels.index(level) > levels.index(site.deadline_escalation)
+            and levels.index(site._get_deadline_level(now)) <= levels.index(level)
+            and not site.stage_site_id.stage_id.fold
+        ))
+        if not sites:
+            return
+        activity_type = self.env.ref('mail.mail_activity_data_todo', raise_if_not_found=False)
+        res_model_id = self.env['ir.model']._get_id('project.project')
+        today = fields.Date.context_today(self)
+        vals_list = []
+        for site in sites:
+            if level == 'overdue':
+                summary = _("Site overdue since %s") % fields.Date.to_string(site.deadline_date.date())
+            else:
+                summary = _("Site deadline on %s") % fields.Date.to_string(site.deadline_date.date())
+            urgent = level == 'overdue' or site.budget >= high_budget
+            vals_list.append({
+                'res_model_id': res_model_id,
+                'res_id': site.id,
+                'activity_type_id': activity_type.id if activity_type else False,
+                'summary': summary,
+                'note': _("Milestone: %s<br/>Budget: %s") % (site.stage_site_id.display_name or '-', site.budget),
+                'date_deadline': today if urgent else site.deadline_date.date(),
+                'user_id': site.user_id.id or self.env.uid,
+            })
+        self.env['mail.activity'].sudo().create(vals_list)
+        sites.write({'deadline_escalation': level})
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super(ProjectProject, self).create(vals_list)
+        records.filtered('deadline_date')._check_deadline_escalation()
+        return records
+
+    def write(self, vals):
+        res = super(ProjectProject, self).write(vals)
+        if {'deadline_date', 'project_size', 'stage_site_id'} & set(vals):
+            self._check_deadline_escalation()
+        return res
+
+    def _check_deadline_escalation(self):
+        """Align the escalation of sites whose deadline, size or milestone changed.
+
+        The cron only sees deadlines crossing a level after its watermark and
+        skips closed milestones, so a deadline moved into the past, or a site
+        leaving a closed milestone, is escalated here; a deadline moved later
+        resets the level so it can be escalated again.
+        """
+        now = fields.Datetime.now()
+        levels = [False] + [key for key, dummy in ESCALATION_LEVELS]
+        by_level = {}
+        for site in self:
+            by_level.setdefault(site._get_deadline_level(now), []).append(site.id)
+        for level, site_ids in by_level.items():
+            sites = self.browse(site_ids)
+            lowered = sites.filtered(lambda site: levels.index(site.deadline_escalation) > levels.index(level))
+            if lowered:
+                lowered.write({'deadline_escalation': level})
+            if level:
+                sites._escalate_deadline(level, now)
+
+
+class ProjectTask(models.Model):
+    _inherit = "project.task"
+
+    def write(self, vals):
+        res = super(ProjectTask, self).write(vals)
+        if 'stage_id' in vals:
+            # sites of a milestone that was reopened are escalated now
+            reopened = self.filtered(lambda task: not task.stage_id.fold)
+            if reopened:
+                self.env['project.project'].search([
+                    ('stage_site_id', 'in', reopened.ids), ('deadline_date', '!=', False),
+                ])._check_deadline_escalation()
+        return res
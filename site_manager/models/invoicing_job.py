@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import fields, models
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+
+class SiteInvoicingJob(models.Model):
+    _name = "site.invoicing.job"
+    _inherit = "site.batch.job.mixin"
+    _description = "Site Invoicing Job"
+    _order = "id desc"
+
+    name = fields.Char(string="Name", required=True, default="New")
+    state = fields.Selection([
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], string="Status", required=True, default='queued')
+    project_ids = fields.Many2many('project.project', 'site_invoicing_job_project_rel', 'job_id', 'project_id', string="Sites")
+    done_project_ids = fields.Many2many('project.project', 'site_invoicing_job_done_project_rel', 'job_id', 'project_id', string="Invoiced Sites")
+    invoice_model = fields.Char(string="Invoice Model", required=True, default='account.invoice')
+    invoice_id = fields.Many2oneReference(string="Invoice", model_field='invoice_model', required=True)
+    # the date range is frozen by the first run so a resumed job invoices the same period
+    start_date = fields.Date(string="Start Date")
+    end_date = fields.Date(string="End Date")
+    chunk_size = fields.Integer(string="Groups per Chunk", default=200)
+    current_project_id = fields.Many2one('project.project', string="Current Site")
+    groups_done = fields.Integer(string="Invoiced Groups")
+    lines_created = fields.Integer(string="Created Lines")
+    hours_done = fields.Float(string="Invoiced Hours")
+    last_error = fields.Text(string="Last Error")
+    company_id = fields.Many2one('res.company', string='Company', default=lambda self: self.env.company)
+
+    def _run(self):
+        """Invoice the remaining sites of the job, committing after each chunk.
+
+        Timesheets linked to the invoice are committed together with their
+        invoice lines, so an interrupted run simply resumes on what is still
+        uninvoiced.
+        """
+        self.ensure_one()
+        Project = self.env['project.project']
+        if not self.start_date or not self.end_date:
+            start_date, end_date = Project._compute_invoice_date_range()
+            self.write({'start_date': start_date, 'end_date': end_date})
+        self.write({'state': 'running', 'last_error': False})
+        self._commit()
+
+        invoice = self.env[self.invoice_model].browse(self.invoice_id)
+        skipped = False
+        for project in self.project_ids - self.done_project_ids:
+            account = project.analytic_account_id
+            if not account:
+                self.write({'done_project_ids': [(4, project.id)]})
+                continue
+            if not Project._try_lock_invoicing_account(account.id, session=True):
+                _logger.info("Analytic account %s is locked by another run, job %s will retry", account.id, self.id)
+                skipped = True
+                continue
+            try:
+                self.write({'current_project_id': project.id})
+                self._run_account(invoice, account.id)
+                self.write({'done_project_ids': [(4, project.id)], 'current_project_id': False})
+                self._commit()
+            except Exception as e:
+                self.env.cr.rollback()
+                _logger.exception("Invoicing job %s failed on site %s", self.id, project.id)
+                message = e.args[0] if isinstance(e, UserError) else str(e)
+                self.write({'state': 'failed', 'last_error': message})
+                self._commit()
+                return False
+            finally:
+                Project._unlock_invoicing_account(account.id)
+
+        if not skipped:
+            self.write({'state': 'done', 'current_project_id': False})
+            self._commit()
+        return True
+
+    def _run_account(self, invoice, analytic_account_id):
+        """Stream the aggregation of one analytic account through a server-side cursor, chunk by chunk.
+
+        A chunk is a bounded number of (section, user) groups; its timesheets
+        are marked by predicate on those groups, so no line id goes through
+        the cursor, and the marked hours are the ones invoiced.
+        """
+        Project = self.env['project.project']
+        sale_orders = Project._get_invoicing_sale_orders([analytic_account_id])
+        sale_order = sale_orders.get(analytic_account_id, False)
+        section_tasks = Project._get_invoicing_sections(sale_orders)
+        if Project._is_invoicing_hook_overridden('_aggregate_timesheets'):
+            # the override chose the lines of each group: the account is invoiced in one chunk
+            groups = Project._aggregate_timesheet_totals(
+                [analytic_account_id], self.start_date, self.end_date, section_tasks=section_tasks,
+            ).get(analytic_account_id, [])
+            Project._mark_timesheet_lines_invoiced(
+                invoice, [line_id for dummy, dummy, dummy, line_ids in groups for line_id in line_ids])
+            self._invoice_chunk(invoice, sale_order, analytic_account_id, groups)
+            return
+        sql, params, dummy = Project._get_timesheet_aggregation_query(
+            [analytic_account_id], self.start_date, self.end_date, section_tasks=section_tasks)
+
+        # WITH HOLD keeps the cursor open across the chunk commits; one left
+        # over by an interrupted run on this connection is closed first
+        cursor_name = 'site_invoicing_job_%s' % self.id
+        self.env.cr.execute("SELECT 1 FROM pg_cursors WHERE name = %s", (cursor_name,))
+        if self.env.cr.fetchone():
+            self.env.cr.execute("CLOSE %s" % cursor_name)
+        self.env.cr.execute("DECLARE %s NO SCROLL CURSOR WITH HOLD FOR %s" % (cursor_name, sql), params)
+        while True:
+            self.env.cr.execute("FETCH FORWARD %s FROM %s" % (int(self.chunk_size) or 200, cursor_name))
+            rows = self.env.cr.fetchall()
+            if not rows:
+                break
+            groups = Project._mark_timesheets_invoiced(
+                invoice, [analytic_account_id], self.start_date, self.end_date, section_tasks=section_tasks,
+                group_keys=[(section_id, user_id) for dummy, section_id, user_id, dummy2 in rows],
+            ).get(analytic_account_id, [])
+            self._invoice_chunk(invoice, sale_order, analytic_account_id, groups)
+        self.env.cr.execute("CLOSE %s" % cursor_name)
+
+    def _invoice_chunk(self, invoice, sale_order, analytic_account_id, groups):
+        """Create the invoice lines of marked groups of an analytic account, and commit them."""
+        Project = self.env['project.project']
+        resolution = Project._get_invoicing_resolution(user_id for dummy, user_id, dummy, dummy in groups)
+        prepared = Project._prepare_invoice_groups(sale_order, groups, resolution)
+        Project._fill_invoice_prices(prepared, resolution)
+        lines = Project._create_prepared_invoice_lines(invoice, {analytic_account_id: prepared})[analytic_account_id]
+        self.write({
+            'groups_done': self.groups_done + len(prepared),
+            'lines_created': self.lines_created + len(lines),
+            'hours_done': self.hours_done + sum(group['qty'] for group in prepared),
+        })
+        self._commit()
+        # drop what the chunk loaded, memory stays bounded by the chunk size
+        self.env.invalidate_all()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from psycopg2 import OperationalError
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+from odoo.service.model import PG_CONCURRENCY_ERRORS_TO_RETRY, MAX_TRIES_ON_CONCURRENCY_FAILURE
+
+_logger = logging.getLogger(__name__)
+
+
+class SiteInvoicingRun(models.Model):
+    _name = "site.invoicing.run"
+    _description = "Site Parallel Invoicing Run"
+    _order = "id desc"
+
+    name = fields.Char(string="Name", required=True, default="New")
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('done', 'Done'),
+    ], string="Status", required=True, default='draft')
+    project_ids = fields.Many2many('project.project', 'site_invoicing_run_project_rel', 'run_id', 'project_id', string="Sites")
+    invoice_model = fields.Char(string="Invoice Model", required=True, default='account.invoice')
+    invoice_id = fields.Many2oneReference(string="Invoice", model_field='invoice_model', required=True)
+    workers = fields.Integer(string="Workers", help="Degree of parallelism, 0 uses the site_manager.invoicing_workers parameter.")
+    duration = fields.Float(string="Duration (s)", readonly=True)
+    result_ids = fields.One2many('site.invoicing.run.result', 'run_id', string="Results", readonly=True)
+    invoiced_count = fields.Integer(string="Invoiced Sites", compute='_compute_counts', store=True)
+    error_count = fields.Integer(string="Sites in Error", compute='_compute_counts', store=True)
+    company_id = fields.Many2one('res.company', string='Company', default=lambda self: self.env.company)
+
+    @api.depends('result_ids.status')
+    def _compute_counts(self):
+        for run in self:
+            run.invoiced_count = len(run.result_ids.filtered(lambda r: r.status == 'invoiced'))
+            run.error_count = len(run.result_ids.filtered(lambda r: r.status == 'error'))
+
+    def _get_workers(self):
+        self.ensure_one()
+        if self.workers > 0:
+            return self.workers
+        return int(self.env['ir.config_parameter'].sudo().get_param('site_manager.invoicing_workers', 4))
+
+    def _get_partitions(self, workers):
+        """Split the sites into ``workers`` partitions, keeping the sites of an analytic account together."""
+        self.ensure_one()
+        by_account = {}
+        for project in self.project_ids:
+            by_account.setdefault(project.analytic_account_id.id, []).append(project.id)
+        partitions = [[] for dummy in range(workers)]
+        # largest accounts first, each one to the lightest partition
+        for project_ids in sorted(by_account.values(), key=len, reverse=True):
+            min(partitions, key=len).extend(project_ids)
+        return [partition for partition in partitions if partition]
+
+    def action_run(self):
+        for run in self:
+            if run.state == 'done':
+                raise UserError(_("Run %s is already done.") % run.name)
+            run._run()
+        return True
+
+    def _run(self):
+        """Invoice the sites of the run over a pool of workers and store the per-site outcomes."""
+        self.ensure_one()
+        started = time.time()
+        workers = self._get_workers()
+        invoice_ref = (self.invoice_model, self.invoice_id)
+        outcomes = {}
+        if workers <= 1 or getattr(threading.current_thread(), 'testing', False):
+            # serial, within the current transaction: one savepoint per site
+            for project_id in self.project_ids.ids:
+                outcomes[project_id] = self._invoice_site_with_retry(self.env, project_id, invoice_ref, commit=False)
+        else:
+            self._check_visible_to_workers()
+            # workers only get plain values: this run may not be committed yet
+            run_partition = partial(self.env['site.invoicing.run']._run_partition,
+                                    self.env.cr.dbname, self.env.uid, self.env.context, invoice_ref)
+            partitions = self._get_partitions(workers)
+            with ThreadPoolExecutor(max_workers=len(partitions), thread_name_prefix='site_invoicing') as executor:
+                for partition_outcomes in executor.map(run_partition, partitions):
+                    outcomes.update(partition_outcomes)
+
+        self.write({
+            'state': 'done',
+            'duration': time.time() - started,
+            'result_ids': [(0, 0, dict(outcome, project_id=project_id)) for project_id, outcome in outcomes.items()],
+        })
+        return True
+
+    def _check_visible_to_workers(self):
+        """Workers read the invoice and the sites from their own connections: refuse to start before they are committed."""
+        self.ensure_one()
+        with self.env.registry.cursor() as cr:
+            cr.execute('SELECT 1 FROM "%s" WHERE id = %%s' % self.env[self.invoice_model]._table, (self.invoice_id,))
+            invoice_visible = bool(cr.fetchone())
+            cr.execute("SELECT COUNT(*) FROM project_project WHERE id = ANY(%s)", (self.project_ids.ids,))
+            sites_visible = cr.fetchone()[0] == len(self.project_ids)
+        if not (invoice_visible and sites_visible):
+            raise UserError(_("Run %s: the invoice and the sites must be saved before they are invoiced in parallel.") % self.name)
+
+    @api.model
+    def _run_partition(self, dbname, uid, context, invoice_ref, project_ids):
+        """Worker: invoice a partition in its own registry cursor, one transaction per site."""
+        thread = threading.current_thread()
+        thread.dbname = dbname
+        thread.uid = uid
+        outcomes = {}
+        with self.env.registry.cursor() as cr:
+            env = api.Environment(cr, uid, context)
+            for project_id in project_ids:
+                outcomes[project_id] = self._invoice_site_with_retry(env, project_id, invoice_ref)
+        return outcomes
+
+    @api.model
+    def _invoice_site_with_retry(self, env, project_id, invoice_ref, commit=True):
+        """Invoice one site and commit, retrying on serialization failures and deadlocks.
+
+        Without ``commit`` the site runs in a savepoint of the current
+        transaction instead; a failing site is undone in both cases and
+        only its outcome is in error.
+        """
+        for attempt in range(1, MAX_TRIES_ON_CONCURRENCY_FAILURE + 1):
+            try:
+                if commit:
+                    outcome = self._invoice_site(env, project_id, invoice_ref)
+                    env.cr.commit()
+                else:
+                    with env.cr.savepoint():
+                        outcome = self._invoice_site(env, project_id, invoice_ref)
+                outcome['attempts'] = attempt
+                return outcome
+            except OperationalError as e:
+                if commit:
+                    env.cr.rollback()
+                env.invalidate_all()
+                if e.pgcode not in PG_CONCURRENCY_ERRORS_TO_RETRY or attempt == MAX_TRIES_ON_CONCURRENCY_FAILURE:
+                    return {'status': 'error', 'message': str(e), 'attempts': attempt}
+                wait_time = random.uniform(0.0, 2 ** attempt)
+                _logger.info("Concurrency error on site %s, retry %s in %.2fs", project_id, attempt, wait_time)
+                time.sleep(wait_time)
+            except Exception as e:
+                if commit:
+                    env.cr.rollback()
+                env.invalidate_all()
+                _logger.exception("Invoicing failed on site %s", project_id)
+                return {'status': 'error', 'message': str(e), 'attempts': attempt}
+
+    @api.model
+    def _invoice_site(self, env, project_id, invoice_ref):
+        """Invoice one site in ``env``; the analytic account advisory lock is taken by create_invoice_line_multi."""
+        invoice_model, invoice_id = invoice_ref
+        invoice = env[invoice_model].browse(invoice_id)
+        result = env['project.project'].browse(project_id).create_invoice_line_multi(invoice)[project_id]
+        return {
+            'status': result['status'],
+            'hours': result['hours'],
+            'line_count': len(result['lines']),
+            'message': result['message'],
+            'attempts': 1,
+        }
+
+
+class SiteInvoicingRunResult(models.Model):
+    _name = "site.invoicing.run.result"
+    _description = "Site Parallel Invoicing Result"
+    _order = "run_id, id"
+
+    run_id = fields.Many2one('site.invoicing.run', string="Run", required=True, ondelete='cascade')
+    project_id = fields.Many2one('project.project', string="Site", required=True, ondelete='cascade')
+    status = fields.Selection([
+        ('invoiced', 'Invoiced'),
+        ('nothing', 'Nothing to Invoice'),
+        ('error', 'Error'),
+    ], string="Status", required=True)
+    hours = fields.Float(string="Hours")
+    line_count = fields.Integer(string="Invoice Lines")
+    attempts = fields.Integer(string="Attempts")
+    message = fields.Text(string="Message")
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import functools
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+
+from odoo import api, fields, models, tools
+
+_logger = logging.getLogger(__name__)
+
+# in-process counters per operation, since the worker started
+_counters = {}
+_counters_lock = threading.Lock()
+
+# sampled calls not written yet, per database; the oldest are dropped first
+SAMPLE_BUFFER_SIZE = 10000
+_samples = {}
+
+
+def instrumented(operation, rows=None, ref=None):
+    """Record call count, SQL queries, duration and rows of a model method.
+
+    - rows: callable(self, args, result) returning the number of rows processed
+    - ref: callable(self, args) returning a short reference of what was processed
+      (sites, requirement, analytic accounts) for the sampled metrics and logs
+
+    The overhead is a cached settings lookup when instrumentation is disabled.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            Sample = self.env['site.metrics.sample']
+            settings = Sample._get_instrumentation_settings()
+            if not settings['enabled']:
+                return method(self, *args, **kwargs)
+            cr = self.env.cr
+            queries = cr.sql_log_count
+            started = time.perf_counter()
+            result = None
+            error = True
+            try:
+                result = method(self, *args, **kwargs)
+                error = False
+                return result
+            finally:
+                duration_ms = (time.perf_counter() - started) * 1000.0
+                try:
+                    Sample._record_call(
+                        operation,
+                        duration_ms=duration_ms,
+                        queries=cr.sql_log_count - queries,
+                        rows=rows(self, args, result) if rows and not error else 0,
+                        ref=ref(self, args) if ref else '',
+                        error=error,
+                        settings=settings,
+                    )
+                except Exception:
+                    _logger.warning("Could not record metrics of %s", operation, exc_info=True)
+        return wrapper
+    return decorator
+
+
+class SiteMetricsSample(models.Model):
+    _name = "site.metrics.sample"
+    _description = "Site Manager Metrics Sample"
+    _order = "id desc"
+
+    operation = fields.Char(string="Operation", required=True, index=True)
+    duration_ms = fields.Float(string="Duration (ms)")
+    query_count = fields.Integer(string="SQL Queries")
+    rows = fields.Integer(string="Rows Processed")
+    ref = fields.Char(string="Reference")
+    error = fields.Boolean(string="Error")
+    user_id = fields.Many2one('res.users', string="User")
+
+    @api.model
+    @tools.ormcache()
+    def _get_instrumentation_settings(self):
+        """Switch and sampling of the instrumentation (system parameters, cached per registry)."""
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        return {
+            'enabled': tools.str2bool(get_param('site_manager.instrumentation', 'False')),
+            'sample_rate': float(get_param('site_manager.instrumentation_sample_rate', '0.01')),
+            'slow_ms': float(get_param('site_manager.instrumentation_slow_ms', '1000')),
+        }
+
+    @api.model
+    def _record_call(self, operation, duration_ms, queries, rows, ref, error, settings):
+        with _counters_lock:
+            counter = _counters.setdefault(operation, {
+                'calls': 0, 'errors': 0, 'queries': 0, 'rows': 0, 'duration_ms': 0.0, 'max_duration_ms': 0.0,
+            })
+            counter['calls'] += 1
+            counter['errors'] += int(error)
+            counter['queries'] += queries
+            counter['rows'] += rows
+            counter['duration_ms'] += duration_ms
+            counter['max_duration_ms'] = max(counter['max_duration_ms'], duration_ms)
+
+        # slow calls are always sampled, the others at the configured rate
+        if duration_ms < settings['slow_ms'] and random.random() >= settings['sample_rate']:
+            return
+        vals = {
+            'operation': operation,
+            'duration_ms': round(duration_ms, 3),
+            'query_count': queries,
+            'rows': rows,
+            'ref': ref,
+            'error': error,
+            'user_id': self.env.uid,
+        }
+        _logger.info("site_manager.metric %s", json.dumps(vals, sort_keys=True))
+        # buffered in memory: the sample survives the rollback of a failed
+        # write without another connection, the next commit of this worker
+        # writes it
+        cr = self.env.cr
+        with _counters_lock:
+            _samples.setdefault(cr.dbname, deque(maxlen=SAMPLE_BUFFER_SIZE)).append(vals)
+        if not cr.precommit.data.get('site_metrics_flush'):
+            cr.precommit.data['site_metrics_flush'] = True
+            cr.precommit.add(self._flush_samples)
+
+    @api.model
+    def _flush_samples(self):
+        """Insert the buffered samples of this worker in the current transaction."""
+        with _counters_lock:
+            buffer = _samples.get(self.env.cr.dbname)
+            samples = list(buffer) if buffer else []
+            if buffer:
+                buffer.clear()
+        if not samples:
+            return
+        columns = ['operation', 'duration_ms', 'query_count', 'rows', 'ref', 'error', 'user_id']
+        try:
+            with self.env.cr.savepoint(flush=False):
+                self.env.cr.execute("""
+                    INSERT INTO site_metrics_sample
+                        (operation, duration_ms, query_count, rows, ref, error, user_id,
+                         create_uid, create_date, write_uid, write_date)
+                    SELECT s.*, %s, now() at time zone 'UTC', %s, now() at time zone 'UTC'
+                    FROM unnest(%s::varchar[], %s::float8[], %s::int[], %s::int[], %s::varchar[], %s::bool[], %s::int[]) AS s
+                """, [self.env.uid, self.env.uid] + [[sample[column] for sample in samples] for column in columns])
+        except Exception:
+            _logger.warning("Could not write %s metrics samples", len(samples), exc_info=True)
+
+    @api.model
+    def get_counters(self):
+        """Snapshot of the in-process counters of this worker, for scraping."""
+        with _counters_lock:
+            return {operation: dict(counter) for operation, counter in _counters.items()}
+
+    @api.autovacuum
+    def _gc_samples(self):
+        days = int(self.env['ir.config_parameter'].sudo().get_param('site_manager.instrumentation_retention_days', 7))
+        self.search([('create_date', '<', fields.Datetime.now() - timedelta(days=days))]).unlink()
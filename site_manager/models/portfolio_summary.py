@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import api, fields, models, tools
+
+_logger = logging.getLogger(__name__)
+
+# project.project fields the summary depends on
+PORTFOLIO_SITE_FIELDS = {'company_id', 'stage_site_id', 'project_size', 'budget', 'deadline_date', 'active'}
+
+
+class SitePortfolioWatermark(models.Model):
+    """Times up to which the portfolio summary is up to date.
+
+    Kept in its own table rather than in ir.config_parameter, whose writes
+    clear every ormcache of the registry.
+    """
+    _name = "site.portfolio.watermark"
+    _description = "Site Portfolio Watermark"
+
+    overdue_until = fields.Datetime(string="Overdue Counts Until", required=True)
+    changes_until = fields.Datetime(string="Site Changes Until")
+
+
+class SitePortfolioDelta(models.Model):
+    """Site changes not folded into the summary yet, one row per site state left (-1) or entered (+1).
+
+    Site writes only insert here, they never lock a shared summary row; the
+    cron folds the rows into the summary. Keys are plain ids, no foreign
+    key is checked on the hot path.
+    """
+    _name = "site.portfolio.delta"
+    _description = "Site Portfolio Pending Change"
+    _log_access = False
+
+    company_id = fields.Integer(string="Company")
+    stage_site_id = fields.Integer(string="Milestone")
+    project_size = fields.Char(string="Project Size")
+    sign = fields.Integer(string="Sign", required=True)
+    budget = fields.Float(string="Budget")
+    deadline_date = fields.Datetime(string="Deadline")
+
+
+class SitePortfolioSummary(models.Model):
+    """Budget and site counts of the active sites per (company, milestone, size).
+
+    Site writes log their changes in site.portfolio.delta, which a cron
+    folds into the rows of their keys, so concurrent writes on a key never
+    wait on each other. Overdue counts depend on the clock: every row counts
+    the sites whose deadline passed at the time of site.portfolio.watermark,
+    and a cron moves that time forward by refreshing the keys of the sites
+    whose deadline passed since. Both are at most one cron interval old, the
+    watermark tells how old.
+    """
+    _name = "site.portfolio.summary"
+    _description = "Site Portfolio Summary"
+    _order = "company_id, stage_site_id, project_size"
+    _log_access = False
+
+    # sites losing their company or milestone through a foreign key are
+    # caught by the daily consistency check
+    company_id = fields.Many2one('res.company', string="Company", ondelete='cascade')
+    stage_site_id = fields.Many2one('project.task', string="Milestone", ondelete='cascade')
+    project_size = fields.Selection([
+        ('small', 'Small'),
+        ('medium', 'Medium'),
+        ('large', 'Large'),
+    ], string="Project Size")
+    site_count = fields.Integer(string="Sites")
+    budget = fields.Float(string="Budget")
+    overdue_count = fields.Integer(string="Overdue Sites")
+    overdue_as_of = fields.Datetime(string="Overdue As Of", compute='_compute_as_of')
+    changes_as_of = fields.Datetime(string="Site Changes As Of", compute='_compute_as_of')
+
+    def init(self):
+        # every column of the key may be NULL, the key must still be unique
+        tools.create_unique_index(
+            self.env.cr, 'site_portfolio_summary_key_uniq', self._table,
+            ['COALESCE(company_id, 0)', 'COALESCE(stage_site_id, 0)', "COALESCE(project_size, '')"])
+        # refresh of a key: the active sites having it
+        tools.create_index(
+            self.env.cr, 'project_project_portfolio_key_idx', 'project_project',
+            ['COALESCE(company_id, 0)', 'COALESCE(stage_site_id, 0)', "COALESCE(project_size, '')"],
+            where="active")
+        self.env.cr.execute("SELECT 1 FROM site_portfolio_summary LIMIT 1")
+        if not self.env.cr.fetchone() or not self.env['site.portfolio.watermark'].sudo().search([], limit=1):
+            self._rebuild()
+
+    def _compute_as_of(self):
+        watermark = self.env['site.portfolio.watermark'].sudo().search([], limit=1)
+        for row in self:
+            row.overdue_as_of = watermark.overdue_until
+            row.changes_as_of = watermark.changes_until
+
+    @api.model
+    def _get_watermark(self):
+        """The watermark of the summary, rebuilding the summary when it is missing."""
+        watermark = self.env['site.portfolio.watermark'].sudo().search([], limit=1)
+        if not watermark:
+            self._rebuild()
+            watermark = self.env['site.portfolio.watermark'].sudo().search([], limit=1)
+        return watermark
+
+    @api.model
+    def _set_watermark(self, vals):
+        Watermark = self.env['site.portfolio.watermark'].sudo()
+        watermark = Watermark.search([], limit=1)
+        if watermark:
+            watermark.write(vals)
+        else:
+            Watermark.create(vals)
+
+    @api.model
+    def _get_live_aggregation_query(self, where=''):
+        """Aggregation of the active sites; its first parameter is the time of the overdue counts."""
+        return """
+            SELECT p.company_id, p.stage_site_id, p.project_size,
+                   COUNT(*) AS site_count,
+                   COALESCE(SUM(p.budget), 0) AS budget,
+                   COUNT(*) FILTER (WHERE p.deadline_date <= %%s) AS overdue_count
+            FROM project_project p
+            WHERE p.active %s
+            GROUP BY p.company_id, p.stage_site_id, p.project_size
+        """ % where
+
+    @api.model
+    def _get_site_states(self, site_ids):
+        """{site_id: (company_id, stage_site_id, project_size, budget, deadline_date)} of the active sites, as stored."""
+        if not site_ids:
+            return {}
+        self.env.cr.execute("""
+            SELECT id, company_id, stage_site_id, project_size, budget, deadline_date
+            FROM project_project
+            WHERE id = ANY(%s) AND active
+        """, (list(site_ids),))
+        return {row[0]: row[1:] for row in self.env.cr.fetchall()}
+
+    @api.model
+    def _log_site_changes(self, before, after):
+        """Insert the changes between two states of the same sites in the pending changes, with one INSERT."""
+        rows = []
+        for site_id in set(before) | set(after):
+            if before.get(site_id) == after.get(site_id):
+                continue
+            if site_id in before:
+                rows.append((-1,) + tuple(before[site_id]))
+            if site_id in after:
+                rows.append((1,) + tuple(after[site_id]))
+        if not rows:
+            return
+        self.env.cr.execute("""
+            INSERT INTO site_portfolio_delta (sign, company_id, stage_site_id, project_size, budget, deadline_date)
+            SELECT * FROM unnest(%s::int[], %s::int[], %s::int[], %s::varchar[], %s::float8[], %s::timestamp[])
+        """, [[row[index] for row in rows] for index in range(6)])
+
+    @api.model
+    def _fold_deltas(self):
+        """Add the pending site changes to the summary rows of their keys.
+
+        The changes are consumed with one DELETE ... RETURNING and added with
+        one upsert on the key index; rows left without sites are deleted.
+        Changes committed meanwhile stay for the next fold.
+        """
+        watermark = self._get_watermark()
+        self.env['site.portfolio.delta'].flush_model()
+        self.flush_model()
+        self.env.cr.execute("""
+            WITH folded AS (
+                DELETE FROM site_portfolio_delta
+                RETURNING company_id, stage_site_id, project_size, sign, budget, deadline_date
+            )
+            INSERT INTO site_portfolio_summary AS s (company_id, stage_site_id, project_size, site_count, budget, overdue_count)
+            SELECT NULLIF(COALESCE(company_id, 0), 0), NULLIF(COALESCE(stage_site_id, 0), 0), NULLIF(COALESCE(project_size, ''), ''),
+                   SUM(sign), SUM(sign * COALESCE(budget, 0)),
+                   COALESCE(SUM(sign) FILTER (WHERE deadline_date <= %s), 0)
+            FROM folded
+            GROUP BY COALESCE(company_id, 0), COALESCE(stage_site_id, 0), COALESCE(project_size, '')
+            ON CONFLICT ((COALESCE(company_id, 0)), (COALESCE(stage_site_id, 0)), (COALESCE(project_size, '')))
+            DO UPDATE SET site_count = s.site_count + EXCLUDED.site_count,
+                          budget = s.budget + EXCLUDED.budget,
+                          overdue_count = s.overdue_count + EXCLUDED.overdue_count
+            RETURNING s.id, s.site_count
+        """, (watermark.overdue_until,))
+        rows = self.env.cr.fetchall()
+        empty_ids = [row_id for row_id, site_count in rows if site_count <= 0]
+        if empty_ids:
+            self.env.cr.execute("DELETE FROM site_portfolio_summary WHERE id = ANY(%s)", (empty_ids,))
+        watermark.changes_until = fields.Datetime.now()
+        self.invalidate_model()
+        return len(rows)
+
+    @api.model
+    def _cron_fold_deltas(self):
+        keys_count = self._fold_deltas()
+        if keys_count:
+            _logger.info("Portfolio summary: folded site changes into %s keys", keys_count)
+
+    @api.model
+    def _refresh_keys(self, keys, overdue_until):
+        """Recompute the summary rows of the given keys from the sites, and only those.
+
+        The pending changes must have been folded first, in the same transaction.
+        """
+        if not keys:
+            return
+        self.env['project.project'].flush_model(list(PORTFOLIO_SITE_FIELDS))
+        self.flush_model()
+        params = [
+            [key[0] or 0 for key in keys],
+            [key[1] or 0 for key in keys],
+            [key[2] or '' for key in keys],
+        ]
+        self.env.cr.execute("""
+            DELETE FROM site_portfolio_summary s
+            USING unnest(%s::int[], %s::int[], %s::varchar[]) AS k(company_id, stage_site_id, project_size)
+            WHERE COALESCE(s.company_id, 0) = k.company_id
+              AND COALESCE(s.stage_site_id, 0) = k.stage_site_id
+              AND COALESCE(s.project_size, '') = k.project_size
+        """, params)
+        # the COALESCE conditions match project_project_portfolio_key_idx
+        self.env.cr.execute("""
+            INSERT INTO site_portfolio_summary
+                (company_id, stage_site_id, project_size, site_count, budget, overdue_count)
+            %s
+        """ % self._get_live_aggregation_query(where="""
+              AND (COALESCE(p.company_id, 0), COALESCE(p.stage_site_id, 0), COALESCE(p.project_size, '')) IN (
+                  SELECT * FROM unnest(%s::int[], %s::int[], %s::varchar[])
+              )"""), [overdue_until] + params)
+        self.invalidate_model()
+
+    @api.model
+    def _rebuild(self):
+        """Rebuild the whole summary from the sites, dropping the pending changes."""
+        now = fields.Datetime.now()
+        self.env['project.project'].flush_model(list(PORTFOLIO_SITE_FIELDS))
+        self.env.cr.execute("DELETE FROM site_portfolio_delta")
+        self.env.cr.execute("DELETE FROM site_portfolio_summary")
+        self.env.cr.execute("""
+            INSERT INTO site_portfolio_summary
+                (company_id, stage_site_id, project_size, site_count, budget, overdue_count)
+            %s
+        """ % self._get_live_aggregation_query(), (now,))
+        self._set_watermark({'overdue_until': now, 'changes_until': now})
+        self.invalidate_model()
+
+    @api.model
+    def _cron_refresh_overdue(self):
+        """Refresh the keys of the sites whose deadline passed since the last run.
+
+        Only the deadlines between the watermark and now are read, on the
+        deadline_date index, whatever the size of the portfolio.
+        """
+        self._fold_deltas()
+        watermark = self._get_watermark()
+        now = fields.Datetime.now()
+        self.env.cr.execute("""
+            SELECT DISTINCT company_id, stage_site_id, project_size
+            FROM project_project
+            WHERE deadline_date > %s AND deadline_date <= %s AND active
+        """, (watermark.overdue_until, now))
+        keys = set(self.env.cr.fetchall())
+        self._refresh_keys(keys, now)
+        watermark.overdue_until = now
+        if keys:
+            _logger.info("Portfolio summary: refreshed overdue counts of %s keys", len(keys))
+
+    @api.model
+    def _check_consistency(self):
+        """Fold the pending changes, then diff the site counts and budgets of the summary against the live aggregation.
+
+        Returns a list of (company_id, stage_site_id, project_size, summary_count, live_count)
+        for every key that differs; an empty list means the summary is up to date.
+        """
+        self._fold_deltas()
+        self.env['project.project'].flush_model(list(PORTFOLIO_SITE_FIELDS))
+        self.env.cr.execute("""
+            SELECT COALESCE(s.company_id, live.company_id),
+                   COALESCE(s.stage_site_id, live.stage_site_id),
+                   COALESCE(s.project_size, live.project_size),
+                   s.site_count, live.site_count
+            FROM site_portfolio_summary s
+            FULL OUTER JOIN (%s) AS live
+              ON live.company_id IS NOT DISTINCT FROM s.company_id
+             AND live.stage_site_id IS NOT DISTINCT FROM s.stage_site_id
+             AND live.project_size IS NOT DISTINCT FROM s.project_size
+            WHERE s.id IS NULL
+               OR live.site_count IS NULL
+               OR s.site_count != live.site_count
+               OR ABS(s.budget - live.budget) > 0.00001
+        """ % self._get_live_aggregation_query(), (fields.Datetime.now(),))
+        return self.env.cr.fetchall()
+
+    @api.model
+    def _cron_check_consistency(self):
+        """Rebuild the summary when it drifted from the sites."""
+        differences = self._check_consistency()
+        if differences:
+            _logger.warning("Portfolio summary out of date on %s keys (e.g. %s), rebuilding", len(differences), differences[:5])
+            self._rebuild()
+
+
+class ProjectProject(models.Model):
+    _inherit = "project.project"
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super(ProjectProject, self).create(vals_list)
+        records.flush_recordset(list(PORTFOLIO_SITE_FIELDS))
+        Summary = self.env['site.portfolio.summary']
+        Summary._log_site_changes({}, Summary._get_site_states(records.ids))
+        return records
+
+    def write(self, vals):
+        if not PORTFOLIO_SITE_FIELDS & set(vals):
+            return super(ProjectProject, self).write(vals)
+        Summary = self.env['site.portfolio.summary']
+        self.flush_recordset(list(PORTFOLIO_SITE_FIELDS))
+        before = Summary._get_site_states(self.ids)
+        res = super(ProjectProject, self).write(vals)
+        self.flush_recordset(list(PORTFOLIO_SITE_FIELDS))
+        Summary._log_site_changes(before, Summary._get_site_states(self.ids))
+        return res
+
+    def unlink(self):
+        Summary = self.env['site.portfolio.summary']
+        self.flush_recordset(list(PORTFOLIO_SITE_FIELDS))
+        before = Summary._get_site_states(self.ids)
+        res = super(ProjectProject, self).unlink()
+        Summary._log_site_changes(before, {})
+        return res
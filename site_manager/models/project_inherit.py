@@ -1,16 +1,39 @@
 # -*- coding: utf-8 -*-
-from odoo import models, fields
+from odoo import models, fields, tools
 
 
 class ProjectProject(models.Model):
     _inherit = "project.project"
 
     # new fields
-    deadline_date = fields.Datetime(string="Deadline Date")
+    deadline_date = fields.Datetime(string="Deadline Date", index='btree_not_null')
     budget = fields.Float(string="Budget")
     project_size = fields.Selection([
         ('small', 'Small'),
         ('medium', 'Medium'),
         ('large', 'Large'),
-    ], string="Project Size")
-    stage_site_id = fields.Many2one('project.task', string="Milestone")
+    ], string="Project Size", index=True)
+    stage_site_id = fields.Many2one('project.task', string="Milestone", index='btree_not_null')
+
+    def init(self):
+        """Indexes of the hot queries on tables owned by other modules (created on install/upgrade)."""
+        cr = self.env.cr
+        # deadline escalation: keyset walk of the deadlines of one project size
+        tools.create_index(
+            cr, 'project_project_size_deadline_idx', 'project_project',
+            ['project_size', 'deadline_date', 'id'], where="deadline_date IS NOT NULL",
+        )
+        # invoicing aggregation: uninvoiced invoiceable timesheets of an account over a date range
+        if all(tools.column_exists(cr, 'account_analytic_line', column)
+               for column in ('invoiceable_analytic_line', 'project_invoice_line_id')):
+            tools.create_index(
+                cr, 'account_analytic_line_site_uninvoiced_idx', 'account_analytic_line',
+                ['account_id', 'date', 'task_id', 'user_id'],
+                where="invoiceable_analytic_line AND project_invoice_line_id IS NULL AND project_id IS NOT NULL",
+            )
+        # section task trees, walked down from each section task
+        if tools.column_exists(cr, 'project_task', 'parent_task_id'):
+            tools.create_index(
+                cr, 'project_task_site_parent_task_active_idx', 'project_task',
+                ['parent_task_id'], where="active AND parent_task_id IS NOT NULL",
+            )
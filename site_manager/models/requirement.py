@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
-from odoo import models, fields, api, _
+from odoo import models, fields, api, tools, _
 from odoo.exceptions import ValidationError
 
+from .metrics import instrumented
+
 class DynamicRequirementField(models.Model):
     _name = "dynamic.requirement.field"
     _description = "Dynamic Requirement (Group)"
@@ -13,6 +15,24 @@ class DynamicRequirementField(models.Model):
     line_ids = fields.One2many('dynamic.requirement.field.line', 'requirement_id', string="Requirement Lines")
     company_id = fields.Many2one('res.company', string='Company')
 
+    # compiled stage rules are cached per registry; any change to the
+    # configuration must drop them (on every worker, via registry signaling)
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super(DynamicRequirementField, self).create(vals_list)
+        self.clear_caches()
+        return records
+
+    def write(self, vals):
+        res = super(DynamicRequirementField, self).write(vals)
+        self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super(DynamicRequirementField, self).unlink()
+        self.clear_caches()
+        return res
+
 
 class DynamicRequirementFieldLine(models.Model):
     _name = "dynamic.requirement.field.line"
@@ -21,84 +41,281 @@ class DynamicRequirementFieldLine(models.Model):
 
     sequence = fields.Integer(string="Sequence", default=10)
     requirement_id = fields.Many2one('dynamic.requirement.field', string="Requirement", ondelete='cascade', required=True)
-    stage_id = fields.Many2one('project.task', string="Milestone", required=True)
+    stage_id = fields.Many2one('project.task', string="Milestone", required=True, index=True)
     mandatory_fields = fields.Many2many('ir.model.fields', 'req_line_model_fields_rel', 'line_id', 'field_id', string="Mandatory Fields")
     custom_warning_msg = fields.Char(string="Custom Warning Message")
     company_id = fields.Many2one('res.company', string='Company')
 
     # domain or constraints could be added to ensure model is project.project fields
 
+    def init(self):
+        # lookup of the compiled rules: (requirement, stage) then company and line order
+        tools.create_index(
+            self.env.cr, 'dynamic_requirement_field_line_rule_idx', self._table,
+            ['requirement_id', 'stage_id', 'company_id', 'sequence', 'id'],
+        )
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super(DynamicRequirementFieldLine, self).create(vals_list)
+        self.clear_caches()
+        return records
+
+    def write(self, vals):
+        # also covers mandatory_fields updates, which go through write
+        res = super(DynamicRequirementFieldLine, self).write(vals)
+        self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super(DynamicRequirementFieldLine, self).unlink()
+        self.clear_caches()
+        return res
+
+    @api.model
+    @tools.ormcache('requirement_id', 'stage_id', 'company_id', 'self.env.lang')
+    def _get_stage_rule(self, requirement_id, stage_id, company_id):
+        """Compiled rule for (requirement, stage, company).
+
+        Returns None when no line applies, otherwise a tuple
+        ``(line_id, custom_warning_msg, ((field_name, label), ...))`` with
+        only the project.project fields of the first matching line.
+        """
+        line = self.sudo().search([
+            ('requirement_id', '=', requirement_id),
+            ('stage_id', '=', stage_id),
+            ('company_id', 'in', [company_id or False, False]),
+        ], limit=1)
+        if not line:
+            return None
+        mandatory = tuple(
+            (irf.name, irf.field_description or irf.name)
+            for irf in line.mandatory_fields
+            if irf.model == 'project.project'
+        )
+        return line.id, line.custom_warning_msg or False, mandatory
+
 class ProjectProject(models.Model):
     _inherit = "project.project"
 
-    requirement_id = fields.Many2one('dynamic.requirement.field', string="Requirement")
+    requirement_id = fields.Many2one('dynamic.requirement.field', string="Requirement", index='btree_not_null')
 
     @api.model
     def _check_record_mandatory_for_stage(self, project_rec, dest_stage):
         """Return (ok True/False, message) for a single project record and dest_stage (record)."""
-        if not project_rec.requirement_id:
-            return True, ''
-        # Find the matching line for dest_stage (same company or no company)
-        lines = project_rec.requirement_id.line_ids.filtered(
-            lambda l: l.stage_id and l.stage_id.id == dest_stage.id and (not l.company_id or l.company_id == project_rec.company_id)
-        )
-        if not lines:
-            return True, ''
-        # take first matching line (you can extend for multiples)
-        line = lines[0]
-        missing = []
-        for irf in line.mandatory_fields:
-            # make sure the field belongs to project.project model
-            if irf.model != 'project.project':
-                # skip fields not on this model
+        violations = project_rec._collect_stage_violations(dest_stage)
+        if violations:
+            return False, violations[0][1]
+        return True, ''
+
+    @api.model
+    def _is_empty_mandatory_value(self, val):
+        """Emptiness test used for mandatory fields (False, None, '' or empty recordset)."""
+        if val is False or val is None or val == '':
+            return True
+        # if recordset (many2one/many2many), check emptiness
+        return hasattr(val, '__len__') and len(val) == 0
+
+    @api.model
+    def _get_mandatory_sql_condition(self, fname):
+        """SQL condition telling whether ``fname`` is empty on row ``p``.
+
+        Returns ``(True, condition)`` when the check can run in SQL,
+        ``(True, None)`` when the field can never be empty for the ORM
+        (numeric columns read back as 0) and ``(False, None)`` when the
+        value must be read through the ORM (computed, non-stored,
+        translated or access-filtered fields).
+        """
+        field = self._fields.get(fname)
+        if field is None or not field.store or field.company_dependent:
+            return False, None
+        if field.type == 'many2many':
+            comodel = self.env[field.comodel_name]
+            # the ORM filters many2many values by field domain and record rules
+            if field.domain or self.env['ir.rule']._compute_domain(comodel._name, 'read'):
+                return False, None
+            return True, 'NOT EXISTS (SELECT 1 FROM "%s" r WHERE r."%s" = p.id)' % (
+                field.relation, field.column1)
+        if not field.column_type or getattr(field, 'translate', False):
+            return False, None
+        if field.type in ('integer', 'float', 'monetary'):
+            return True, None
+        if field.type == 'boolean':
+            return True, 'p."%s" IS NOT TRUE' % fname
+        if field.type in ('char', 'text', 'html', 'selection'):
+            return True, '(p."%s" IS NULL OR p."%s" = \'\')' % (fname, fname)
+        if field.type in ('many2one', 'date', 'datetime', 'reference'):
+            return True, 'p."%s" IS NULL' % fname
+        return False, None
+
+    def _get_missing_mandatory_fields(self, mandatory):
+        """Return {project_id: [labels]} of the mandatory (field_name, label) pairs left empty.
+
+        Stored columns and plain many2many relations are checked in one SQL
+        query for the whole recordset; the other fields are read through the
+        prefetch of ``self``, so the cost never grows with the number of
+        records.
+        """
+        sql_checks = []
+        orm_fields = []
+        for fname, label in mandatory:
+            sql_ok, condition = self._get_mandatory_sql_condition(fname)
+            if not sql_ok:
+                orm_fields.append(fname)
+            elif condition:
+                sql_checks.append((fname, condition))
+
+        empty = {}
+        if sql_checks and self.ids:
+            self.flush_recordset([fname for fname, dummy in sql_checks])
+            query = """
+                SELECT p.id, %s
+                FROM project_project p
+                WHERE p.id = ANY(%%s)
+                  AND (%s)
+            """ % (
+                ', '.join(condition for dummy, condition in sql_checks),
+                ' OR '.join(condition for dummy, condition in sql_checks),
+            )
+            self.env.cr.execute(query, (list(self.ids),))
+            for row in self.env.cr.fetchall():
+                for (fname, dummy), is_empty in zip(sql_checks, row[1:]):
+                    if is_empty:
+                        empty.setdefault(row[0], set()).add(fname)
+
+        for fname in orm_fields:
+            for rec in self:
+                # safe getattr (if relation fields, will return recordset)
+                try:
+                    val = rec[fname]
+                except Exception:
+                    val = False
+                if self._is_empty_mandatory_value(val):
+                    empty.setdefault(rec.id, set()).add(fname)
+
+        # keep the labels in the order of the requirement line
+        return {
+            rec_id: [label for fname, label in mandatory if fname in fnames]
+            for rec_id, fnames in empty.items()
+        }
+
+    @instrumented('requirement.collect_violations', rows=lambda self, args, result: len(self),
+                  ref=lambda self, args: 'stage:%s sites:%s' % (args[0].id, ','.join(map(str, self.ids[:20]))))
+    def _collect_stage_violations(self, dest_stage):
+        """Return [(project, message)] for every record of self blocked from dest_stage."""
+        messages = self._get_transition_violations([(rec, dest_stage) for rec in self])
+        return [(rec, messages[rec.id, dest_stage.id]) for rec in self if (rec.id, dest_stage.id) in messages]
+
+    def _get_transition_violations(self, transitions):
+        """Return {(project_id, stage_id): message} for the blocked (project, dest_stage) pairs.
+
+        Pairs sharing the same mandatory fields are checked together, so the
+        number of queries depends on the requirement configuration, not on
+        the number of pairs.
+        """
+        Line = self.env['dynamic.requirement.field.line']
+        # requirement_id and company_id are prefetched for all the projects at once
+        pairs_by_mandatory = {}
+        for rec, dest_stage in transitions:
+            if not rec.requirement_id:
                 continue
-            fname = irf.name
-            # safe getattr (if relation fields, will return recordset)
-            try:
-                val = project_rec[fname]
-            except Exception:
-                val = False
-            # evaluate emptiness depending on field type:
-            if val is False or val is None or val == '':
-                missing.append(irf.field_description or fname)
+            rule = Line._get_stage_rule(rec.requirement_id.id, dest_stage.id, rec.company_id.id)
+            if rule:
+                dummy, custom_warning_msg, mandatory = rule
+                pairs_by_mandatory.setdefault(mandatory, []).append((rec.id, dest_stage.id, custom_warning_msg))
+
+        messages = {}
+        for mandatory, pairs in pairs_by_mandatory.items():
+            records = self.browse(list(dict.fromkeys(rec_id for rec_id, dummy, dummy2 in pairs)))
+            missing = records._get_missing_mandatory_fields(mandatory)
+            for rec_id, stage_id, custom_warning_msg in pairs:
+                if rec_id not in missing:
+                    continue
+                if custom_warning_msg:
+                    messages[rec_id, stage_id] = custom_warning_msg
+                else:
+                    messages[rec_id, stage_id] = _('Missing required fields: %s') % (', '.join(missing[rec_id]))
+        return messages
+
+    @api.model
+    @instrumented('requirement.validate_transitions', rows=lambda self, args, result: len(result))
+    def validate_stage_transitions(self, transitions):
+        """Dry run of moving sites to milestones: nothing is written.
+
+        ``transitions`` is a list of ``[site_id, stage_id]`` pairs (or of
+        ``{'site_id': ..., 'stage_id': ...}`` dicts). Returns, in the same
+        order, ``{'site_id', 'stage_id', 'valid', 'message'}`` for every pair,
+        with the message write() would raise for the blocked ones.
+        """
+        pairs = []
+        for transition in transitions:
+            if isinstance(transition, dict):
+                pairs.append((transition.get('site_id'), transition.get('stage_id')))
             else:
-                # if recordset (many2one/many2many), check emptiness
-                if hasattr(val, '__len__') and len(val) == 0:
-                    missing.append(irf.field_description or fname)
-        if missing:
-            if line.custom_warning_msg:
-                return False, line.custom_warning_msg
+                site_id, stage_id = transition
+                pairs.append((site_id, stage_id))
+
+        # one search per model for the whole batch; unknown or unreadable ids are reported
+        sites = self.search([('id', 'in', list({site_id for site_id, dummy in pairs if site_id}))])
+        stages = self.env['project.task'].search([('id', 'in', list({stage_id for dummy, stage_id in pairs if stage_id}))])
+        known_sites, known_stages = set(sites.ids), set(stages.ids)
+
+        transitions_to_check = [
+            (self.browse(site_id).with_prefetch(sites._prefetch_ids), stages.browse(stage_id))
+            for site_id, stage_id in pairs
+            if site_id in known_sites and stage_id in known_stages
+        ]
+        messages = self._get_transition_violations(transitions_to_check)
+
+        result = []
+        for site_id, stage_id in pairs:
+            if site_id not in known_sites:
+                message = _('Unknown site.')
+            elif stage_id and stage_id not in known_stages:
+                message = _('Unknown milestone.')
             else:
-                return False, _('Missing required fields: %s') % (', '.join(missing))
-        return True, ''
+                message = messages.get((site_id, stage_id), False)
+            result.append({'site_id': site_id, 'stage_id': stage_id, 'valid': not message, 'message': message})
+        return result
+
+    @api.model
+    def _get_dest_stage_from_vals(self, new_stage_id):
+        """Resolve the stage_id value given to write() into an existing stage record (or False)."""
+        dest_stage = False
+        if isinstance(new_stage_id, (list, tuple)):
+
+            if new_stage_id and isinstance(new_stage_id[0], int):
+                # take second element if (4, id)
+                if len(new_stage_id) >= 2 and isinstance(new_stage_id[1], int):
+                    dest_stage = self.env['project.task'].browse(new_stage_id[1])
+        elif isinstance(new_stage_id, int):
+            dest_stage = self.env['project.task'].browse(new_stage_id)
+        elif isinstance(new_stage_id, bool) and not new_stage_id:
+            dest_stage = False
+        else:
+            try:
+                sid = int(new_stage_id)
+                dest_stage = self.env['project.task'].browse(sid)
+            except Exception:
+                dest_stage = False
+        if dest_stage and dest_stage.exists():
+            return dest_stage
+        return False
 
     def write(self, vals):
 
-        if 'stage_id' in vals:
+        # the milestone of a site is stage_site_id, a project.task like the
+        # requirement lines; stage_id is a project.project.stage, not checked
+        if 'stage_site_id' in vals:
             # If stage is set to falsy, skip
-            new_stage_id = vals.get('stage_id')
-            for rec in self:
-                # determine destination stage record
-                dest_stage = False
-                if isinstance(new_stage_id, (list, tuple)):
-
-                    if new_stage_id and isinstance(new_stage_id[0], int):
-                        # take second element if (4, id)
-                        if len(new_stage_id) >= 2 and isinstance(new_stage_id[1], int):
-                            dest_stage = self.env['project.task'].browse(new_stage_id[1])
-                elif isinstance(new_stage_id, int):
-                    dest_stage = self.env['project.task'].browse(new_stage_id)
-                elif isinstance(new_stage_id, bool) and not new_stage_id:
-                    dest_stage = False
-                else:
-                    try:
-                        sid = int(new_stage_id)
-                        dest_stage = self.env['project.task'].browse(sid)
-                    except Exception:
-                        dest_stage = False
-
-                if dest_stage and dest_stage.exists():
-                    ok, msg = self._check_record_mandatory_for_stage(rec, dest_stage)
-                    if not ok:
-                        raise ValidationError(msg)
+            dest_stage = self._get_dest_stage_from_vals(vals.get('stage_site_id'))
+            if dest_stage:
+                violations = self._collect_stage_violations(dest_stage)
+                if len(violations) == 1 and len(self) == 1:
+                    raise ValidationError(violations[0][1])
+                if violations:
+                    raise ValidationError(_("The following sites cannot be moved to %s:\n%s") % (
+                        dest_stage.display_name,
+                        '\n'.join('- %s: %s' % (rec.display_name, msg) for rec, msg in violations),
+                    ))
         return super(ProjectProject, self).write(vals)
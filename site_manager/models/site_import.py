@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+import base64
+import csv
+import io
+import itertools
+import logging
+
+from psycopg2 import IntegrityError
+
+from odoo import fields, models, _
+from odoo.exceptions import UserError, ValidationError
+
+_logger = logging.getLogger(__name__)
+
+# errors caused by the data of a row: the row is rejected, anything else fails the job
+ROW_ERRORS = (ValidationError, UserError, ValueError, IntegrityError)
+
+
+class _RejectedBatch(Exception):
+    """Raised inside the batch savepoint to undo the creation when some rows are blocked."""
+
+
+class SiteImportJob(models.Model):
+    _name = "site.import.job"
+    _inherit = "site.batch.job.mixin"
+    _description = "Site Import Job"
+    _order = "id desc"
+
+    name = fields.Char(string="Name", required=True, default="New")
+    state = fields.Selection([
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], string="Status", required=True, default='queued')
+    file = fields.Binary(string="CSV File", attachment=True, required=True)
+    file_name = fields.Char(string="File Name")
+    delimiter = fields.Char(string="Delimiter", required=True, default=',', size=1)
+    batch_size = fields.Integer(string="Rows per Batch", default=1000)
+    # data rows already processed, an interrupted job resumes after them
+    rows_done = fields.Integer(string="Processed Rows")
+    created_count = fields.Integer(string="Created Sites")
+    rejected_count = fields.Integer(string="Rejected Rows")
+    rejection_ids = fields.One2many('site.import.rejection', 'job_id', string="Rejected Rows")
+    last_error = fields.Text(string="Last Error")
+    company_id = fields.Many2one('res.company', string='Company', default=lambda self: self.env.company)
+
+    def _open_file(self):
+        """Text stream of the CSV file, read from the filestore when possible instead of loaded in memory."""
+        attachment = self.env['ir.attachment'].sudo().search([
+            ('res_model', '=', self._name), ('res_field', '=', 'file'), ('res_id', '=', self.id),
+        ], limit=1)
+        if attachment.store_fname:
+            stream = open(attachment._full_path(attachment.store_fname), 'rb')
+        else:
+            stream = io.BytesIO(base64.b64decode(self.with_context(bin_size=False).file or b''))
+        return io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+
+    def _run(self):
+        """Import the remaining rows of the file, one committed batch at a time."""
+        self.ensure_one()
+        self.write({'state': 'running', 'last_error': False})
+        self._commit()
+        batch_size = int(self.batch_size) or 1000
+        try:
+            with self._open_file() as text:
+                reader = csv.reader(text, delimiter=self.delimiter or ',')
+                header = [column.strip() for column in next(reader, [])]
+                converters = self._get_converters(header)
+                # row numbers are the line numbers of the file, header being line 1
+                rows = enumerate(itertools.islice(reader, self.rows_done, None), start=self.rows_done + 2)
+                while True:
+                    batch = list(itertools.islice(rows, batch_size))
+                    if not batch:
+                        break
+                    created, rejections = self._import_batch(header, converters, batch)
+                    self.env['site.import.rejection'].create(rejections)
+                    self.write({
+                        'rows_done': self.rows_done + len(batch),
+                        'created_count': self.created_count + created,
+                        'rejected_count': self.rejected_count + len(rejections),
+                    })
+                    self._commit()
+                    # drop what the batch loaded, memory stays bounded by the batch size
+                    self.env.invalidate_all()
+        except Exception as e:
+            self.env.cr.rollback()
+            _logger.exception("Site import job %s failed", self.id)
+            message = e.args[0] if isinstance(e, UserError) else str(e)
+            self.write({'state': 'failed', 'last_error': message})
+            self._commit()
+            return False
+        self.write({'state': 'done'})
+        self._commit()
+        return True
+
+    def _get_converters(self, header):
+        """{column: field} of the header, every column must be a stored field of project.project."""
+        Project = self.env['project.project']
+        converters = {}
+        for column in header:
+            field = Project._fields.get(column)
+            if not field or not field.store or field.type in ('one2many', 'many2many', 'binary'):
+                raise UserError(_("Column %s is not an importable site field.") % column)
+            converters[column] = field
+        if 'name' not in converters:
+            raise UserError(_("The file must have a name column."))
+        return converters
+
+    def _resolve_many2one(self, converters, parsed):
+        """{(column, value): id} of the many2one values of the batch, with one search per column.
+
+        Values are database ids or the exact display name of the record.
+        """
+        resolved = {}
+        for column, field in converters.items():
+            if field.type != 'many2one':
+                continue
+            values = {row[column] for row in parsed if row.get(column)}
+            if not values:
+                continue
+            comodel = self.env[field.comodel_name]
+            ids = {int(value) for value in values if value.isdigit()}
+            names = values - {str(i) for i in ids}
+            for record_id in comodel.browse(ids).exists().ids:
+                resolved[column, str(record_id)] = record_id
+            if names:
+                found = {}
+                for record in comodel.search([(comodel._rec_name, 'in', list(names))]):
+                    found.setdefault(record[comodel._rec_name], []).append(record.id)
+                for name, record_ids in found.items():
+                    # ambiguous names are left unresolved and rejected
+                    if len(record_ids) == 1:
+                        resolved[column, name] = record_ids[0]
+        return resolved
+
+    def _convert_row(self, converters, row, resolved, selections):
+        """Create values of one parsed row; raises ValueError with the reason of a rejection."""
+        vals = {}
+        for column, value in row.items():
+            field = converters[column]
+            if value == '':
+                continue
+            if field.type == 'many2one':
+                if (column, value) not in resolved:
+                    raise ValueError(_("%s: no single record matches %r") % (column, value))
+                vals[column] = resolved[column, value]
+            elif field.type in ('float', 'monetary'):
+                vals[column] = float(value)
+            elif field.type == 'integer':
+                vals[column] = int(value)
+            elif field.type == 'boolean':
+                vals[column] = value.strip().lower() in ('1', 'true', 'yes')
+            elif field.type == 'date':
+                vals[column] = fields.Date.to_date(value)
+            elif field.type == 'datetime':
+                vals[column] = fields.Datetime.to_datetime(value)
+            elif field.type == 'selection':
+                if value not in selections[column]:
+                    raise ValueError(_("%s: %r is not one of %s") % (column, value, ', '.join(selections[column])))
+                vals[column] = value
+            else:
+                vals[column] = value
+        if 'company_id' not in vals:
+            vals['company_id'] = self.company_id.id
+        return vals
+
+    def _import_batch(self, header, converters, batch):
+        """Create the sites of a batch of (row_number, cells), returns (created count, rejection values)."""
+        rejections = []
+        parsed = []
+        for row_number, cells in batch:
+            if len(cells) != len(header):
+                rejections.append(self._prepare_rejection(row_number, cells, _("Expected %s columns, got %s") % (len(header), len(cells))))
+                continue
+            parsed.append((row_number, cells, dict(zip(header, cells))))
+
+        resolved = self._resolve_many2one(converters, [row for dummy, dummy2, row in parsed])
+        selections = {
+            column: [key for key, dummy in field._description_selection(self.env)]
+            for column, field in converters.items() if field.type == 'selection'
+        }
+        candidates = []
+        for row_number, cells, row in parsed:
+            try:
+                candidates.append((row_number, cells, self._convert_row(converters, row, resolved, selections)))
+            except ValueError as e:
+                rejections.append(self._prepare_rejection(row_number, cells, str(e)))
+
+        # milestones of the batch checked at once, with the same rules as a write of stage_site_id
+        Project = self.env['project.project'].with_context(
+            tracking_disable=True, mail_create_nolog=True, mail_create_nosubscribe=True)
+        stages = self.env['project.task'].browse(
+            {vals['stage_site_id'] for dummy, dummy2, vals in candidates if vals.get('stage_site_id')}).exists()
+        stage_ids = set(stages.ids)
+        while candidates:
+            try:
+                with self.env.cr.savepoint():
+                    records = Project.create([vals for dummy, dummy2, vals in candidates])
+                    checked = [
+                        (index, rec, vals['stage_site_id'])
+                        for index, (rec, (dummy, dummy2, vals)) in enumerate(zip(records, candidates))
+                        if vals.get('stage_site_id') in stage_ids
+                    ]
+                    violations = Project._get_transition_violations([(rec, stages.browse(stage_id)) for dummy, rec, stage_id in checked])
+                    blocked = {
+                        index: violations[rec.id, stage_id]
+                        for index, rec, stage_id in checked if (rec.id, stage_id) in violations
+                    }
+                    if blocked:
+                        raise _RejectedBatch(blocked)
+                return len(records), rejections
+            except _RejectedBatch as e:
+                # the savepoint undid the whole batch, create it again without the blocked rows
+                blocked = e.args[0]
+                for index, message in blocked.items():
+                    row_number, cells, dummy = candidates[index]
+                    rejections.append(self._prepare_rejection(row_number, cells, message))
+                candidates = [candidate for index, candidate in enumerate(candidates) if index not in blocked]
+            except ROW_ERRORS:
+                # a constraint failed somewhere in the batch, find the rows one by one
+                return self._import_rows_one_by_one(Project, candidates, rejections)
+        return 0, rejections
+
+    def _import_rows_one_by_one(self, Project, candidates, rejections):
+        created = 0
+        for row_number, cells, vals in candidates:
+            try:
+                with self.env.cr.savepoint():
+                    record = Project.create(vals)
+                    if vals.get('stage_site_id'):
+                        violations = record._collect_stage_violations(self.env['project.task'].browse(vals['stage_site_id']))
+                        if violations:
+                            raise _RejectedBatch(violations[0][1])
+                created += 1
+            except (_RejectedBatch,) + ROW_ERRORS as e:
+                reason = e.args[0] if e.args else str(e)
+                rejections.append(self._prepare_rejection(row_number, cells, str(reason)))
+        return created, rejections
+
+    def _prepare_rejection(self, row_number, cells, reason):
+        return {
+            'job_id': self.id,
+            'row_number': row_number,
+            'reason': reason,
+            'data': self.delimiter.join(cells),
+        }
+
+
+class SiteImportRejection(models.Model):
+    _name = "site.import.rejection"
+    _description = "Site Import Rejected Row"
+    _order = "job_id, row_number"
+
+    job_id = fields.Many2one('site.import.job', string="Import Job", required=True, ondelete='cascade', index=True)
+    row_number = fields.Integer(string="Line")
+    reason = fields.Text(string="Reason")
+    data = fields.Text(string="Row")
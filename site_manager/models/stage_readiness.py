@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from odoo import api, fields, models, tools
+
+
+class SiteStageReadiness(models.Model):
+    _name = "site.stage.readiness"
+    _description = "Site Readiness per Milestone"
+    _order = "project_id, sequence, id"
+
+    project_id = fields.Many2one('project.project', string="Site", required=True, ondelete='cascade', index=True)
+    stage_id = fields.Many2one('project.task', string="Milestone", required=True, ondelete='cascade')
+    line_id = fields.Many2one('dynamic.requirement.field.line', string="Requirement Line", ondelete='cascade')
+    sequence = fields.Integer(related='line_id.sequence', string="Sequence")
+    ready = fields.Boolean(string="Ready")
+    missing_fields = fields.Char(string="Missing Fields")
+
+    _sql_constraints = [
+        ('project_stage_uniq', 'unique (project_id, stage_id)', 'A site has one readiness per milestone.'),
+    ]
+
+    def init(self):
+        # first install on a database that already has configured requirements
+        self.env.cr.execute("SELECT 1 FROM site_stage_readiness LIMIT 1")
+        if not self.env.cr.fetchone():
+            self.env['project.project'].search([('requirement_id', '!=', False)])._refresh_stage_readiness()
+
+
+# line fields that change the readiness of the sites of the requirement
+READINESS_LINE_FIELDS = {'requirement_id', 'stage_id', 'mandatory_fields', 'company_id', 'sequence'}
+
+
+class DynamicRequirementFieldLine(models.Model):
+    _inherit = "dynamic.requirement.field.line"
+
+    @api.model
+    @tools.ormcache('requirement_id', 'company_id')
+    def _get_requirement_stage_ids(self, requirement_id, company_id):
+        """Milestones having a line of the requirement for the company (or for no company)."""
+        lines = self.sudo().search([
+            ('requirement_id', '=', requirement_id),
+            ('company_id', 'in', [company_id or False, False]),
+        ])
+        return tuple(dict.fromkeys(lines.stage_id.ids))
+
+    @api.model
+    @tools.ormcache()
+    def _get_readiness_trigger_fields(self):
+        """Names of the project.project fields mandatory in any requirement line."""
+        self.env.cr.execute("""
+            SELECT DISTINCT f.name
+            FROM req_line_model_fields_rel rel
+            JOIN ir_model_fields f ON f.id = rel.field_id
+            WHERE f.model = 'project.project'
+        """)
+        return frozenset(row[0] for row in self.env.cr.fetchall())
+
+    def _refresh_requirement_sites(self, requirement_ids, stage_ids):
+        """Refresh the readiness of the sites of the requirements, for the given milestones only."""
+        if requirement_ids and stage_ids:
+            self.env['project.project'].search([
+                ('requirement_id', 'in', list(requirement_ids)),
+            ])._refresh_stage_readiness(stage_ids=stage_ids)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super(DynamicRequirementFieldLine, self).create(vals_list)
+        self._refresh_requirement_sites(set(records.requirement_id.ids), set(records.stage_id.ids))
+        return records
+
+    def write(self, vals):
+        if not READINESS_LINE_FIELDS & set(vals):
+            return super(DynamicRequirementFieldLine, self).write(vals)
+        requirement_ids = set(self.requirement_id.ids)
+        stage_ids = set(self.stage_id.ids)
+        res = super(DynamicRequirementFieldLine, self).write(vals)
+        self._refresh_requirement_sites(requirement_ids | set(self.requirement_id.ids), stage_ids | set(self.stage_id.ids))
+        return res
+
+    def unlink(self):
+        requirement_ids = set(self.requirement_id.ids)
+        stage_ids = set(self.stage_id.ids)
+        res = super(DynamicRequirementFieldLine, self).unlink()
+        self._refresh_requirement_sites(requirement_ids, stage_ids)
+        return res
+
+
+class ProjectProject(models.Model):
+    _inherit = "project.project"
+
+    stage_readiness_ids = fields.One2many('site.stage.readiness', 'project_id', string="Milestone Readiness")
+    stage_blocked_count = fields.Integer(string="Blocked Milestones", compute='_compute_stage_blockers', store=True)
+    stage_blockers = fields.Char(string="Blockers", compute='_compute_stage_blockers', store=True)
+
+    @api.depends('stage_readiness_ids.ready', 'stage_readiness_ids.missing_fields')
+    def _compute_stage_blockers(self):
+        for project in self:
+            blocked = project.stage_readiness_ids.filtered(lambda r: not r.ready)
+            project.stage_blocked_count = len(blocked)
+            project.stage_blockers = '; '.join(
+                '%s: %s' % (readiness.stage_id.display_name, readiness.missing_fields) for readiness in blocked
+            ) or False
+
+    def _refresh_stage_readiness(self, stage_ids=None):
+        """Recompute the readiness of these sites for every milestone of their requirement.
+
+        Works set-wise per (requirement, company) and milestone, then only
+        writes the readiness rows whose value changed. ``stage_ids`` restricts
+        the milestones recomputed and the readiness rows read to those.
+        """
+        Line = self.env['dynamic.requirement.field.line']
+        records_by_group = {}
+        for rec in self:
+            if rec.requirement_id:
+                records_by_group.setdefault((rec.requirement_id.id, rec.company_id.id), []).append(rec.id)
+
+        expected = {}
+        for (requirement_id, company_id), record_ids in records_by_group.items():
+            records = self.browse(record_ids)
+            for stage_id in Line._get_requirement_stage_ids(requirement_id, company_id):
+                if stage_ids is not None and stage_id not in stage_ids:
+                    continue
+                line_id, dummy, mandatory = Line._get_stage_rule(requirement_id, stage_id, company_id)
+                missing = records._get_missing_mandatory_fields(mandatory)
+                for rec_id in record_ids:
+                    labels = missing.get(rec_id)
+                    expected[(rec_id, stage_id)] = (line_id, not labels, ', '.join(labels) if labels else False)
+
+        Readiness = self.env['site.stage.readiness'].sudo()
+        to_unlink = Readiness
+        to_write = {}
+        domain = [('project_id', 'in', self.ids)]
+        if stage_ids is not None:
+            domain.append(('stage_id', 'in', list(stage_ids)))
+        for readiness in Readiness.search(domain):
+            values = expected.pop((readiness.project_id.id, readiness.stage_id.id), None)
+            if values is None:
+                to_unlink |= readiness
+            elif values != (readiness.line_id.id, readiness.ready, readiness.missing_fields):
+                to_write.setdefault(values, []).append(readiness.id)
+        to_unlink.unlink()
+        # one write per distinct value, not per row
+        for (line_id, ready, missing_fields), readiness_ids in to_write.items():
+            Readiness.browse(readiness_ids).write({'line_id': line_id, 'ready': ready, 'missing_fields': missing_fields})
+        Readiness.create([{
+            'project_id': project_id,
+            'stage_id': stage_id,
+            'line_id': line_id,
+            'ready': ready,
+            'missing_fields': missing_fields,
+        } for (project_id, stage_id), (line_id, ready, missing_fields) in expected.items()])
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super(ProjectProject, self).create(vals_list)
+        records.filtered('requirement_id')._refresh_stage_readiness()
+        return records
+
+    def write(self, vals):
+        res = super(ProjectProject, self).write(vals)
+        # only the sites whose referenced mandatory values changed
+        trigger_fields = self.env['dynamic.requirement.field.line']._get_readiness_trigger_fields()
+        if {'requirement_id', 'company_id'} & set(vals) or trigger_fields & set(vals):
+            self._refresh_stage_readiness()
+        return res
@@ -4,8 +4,18 @@ from odoo.exceptions import UserError
 from datetime import date, timedelta
 import logging
 
+from .metrics import instrumented
+from .timesheet_summary import SUMMARY_LINE_FIELDS, UNINVOICED_LINE_FILTER
+
 _logger = logging.getLogger(__name__)
 
+# first key of the advisory locks taken per analytic account while invoicing
+INVOICING_LOCK_NAMESPACE = 74010
+
+
+class _InvoiceGroupError(Exception):
+    """Raised inside the marking savepoint when the drifted groups of an account cannot be invoiced."""
+
 
 class ProjectProject(models.Model):
     _inherit = "project.project"
@@ -21,55 +31,43 @@ class ProjectProject(models.Model):
 
     @api.model
     def _aggregate_timesheets(self, analytic_account_id, start_date, end_date, task_ids=None):
+        """Uninvoiced hours of one analytic account as [(user_id, total_hours, line_ids), ...].
 
+        Batch invoicing reads its totals from the weekly summary, and only goes
+        through this method, per account or section, when a module overrides it.
+        """
         if not analytic_account_id:
             return []
 
         params = [analytic_account_id, start_date, end_date]
         sql = """
-            SELECT user_id, SUM(unit_amount) AS total_hours,
-                   array_agg(id) AS line_ids
-            FROM account_analytic_line
-            WHERE account_id = %s
-              AND invoiceable_analytic_line = 't'
-              AND date >= %s
-              AND date <= %s
-              AND project_id IS NOT NULL
-              AND project_invoice_line_id IS NULL
-        """
-        if task_ids:
-            # safe guard: ensure task_ids is non-empty list/tuple
-            t_ids = tuple(int(x) for x in task_ids) if task_ids else ()
+            SELECT l.user_id, SUM(l.unit_amount) AS total_hours,
+                   array_agg(l.id) AS line_ids
+            FROM account_analytic_line l
+            WHERE l.account_id = %%s
+              AND l.date >= %%s
+              AND l.date <= %%s
+              AND %s
+        """ % UNINVOICED_LINE_FILTER
+        if task_ids is not None:
+            t_ids = tuple(int(x) for x in task_ids)
             if not t_ids:
                 return []
-            sql += " AND task_id IN %s"
+            sql += " AND l.task_id IN %s"
             params.append(t_ids)
 
-        sql += " GROUP BY user_id ORDER BY user_id ASC"
+        sql += " GROUP BY l.user_id ORDER BY l.user_id ASC"
+        self.env['account.analytic.line'].flush_model(list(SUMMARY_LINE_FIELDS))
         self.env.cr.execute(sql, tuple(params))
-        rows = self.env.cr.fetchall()
-        # rows: [(user_id, total_hours, [id1,id2,...]), ...]
-        results = []
-        for row in rows:
-            user_id = row[0]
-            total_hours = row[1] or 0.0
-            line_ids = row[2] or []
-            results.append((user_id, float(total_hours), tuple(line_ids)))
-        return results
+        return [(user_id, float(total_hours or 0.0), tuple(line_ids or ())) for user_id, total_hours, line_ids in self.env.cr.fetchall()]
 
     @api.model
-    def _determine_product_and_price(self, sale_order, employee, fallback_employee_data):
-        """
-        Returns (product_record, price_unit, uom_id)
-        - sale_order: sale.order record or False
-        - employee: hr.employee record or empty
-        - fallback_employee_data: dict returned by action_search_employee if no hr.employee exists
-        """
+    def _determine_invoice_product(self, employee, fallback_employee_data):
+        """Returns (product_record, uom_id) invoiced for an employee or its fallback data."""
         # Determine product (inhouse vs outsource)
         company = self.env.user.company_id
         product = False
         uom_id = False
-        price_unit = 0.0
 
         if employee:
             job = getattr(employee, 'job_id', False)
@@ -90,32 +88,40 @@ class ProjectProject(models.Model):
 
         if not product:
             raise UserError(_("No product found for employee / fallback data."))
+        return product, uom_id
 
-        # Determine price_unit: if sale order has pricelist and partner, compute pricelist price
+    @api.model
+    def _get_invoice_price_key(self, sale_order):
+        """Key of the pricelist prices of a sale order: (pricelist, partner, date) or None for list prices."""
         if sale_order and sale_order.pricelist_id and sale_order.partner_id:
-            # Build product with context for pricelist
-            try:
-                product_variant = product.with_context(
-                    lang=sale_order.partner_id.lang,
-                    partner=sale_order.partner_id.id,
-                    quantity=1,
-                    date=sale_order.date_order,
-                    pricelist=sale_order.pricelist_id.id,
-                    uom=product.uom_id.id if product.uom_id else None,
-                )
-                # use the product price (tax complication omitted; adapt if needed)
-                price_unit = product_variant.price
-            except Exception:
-                price_unit = product.list_price
-        else:
-            price_unit = product.list_price
+            return sale_order.pricelist_id.id, sale_order.partner_id.id, sale_order.date_order
+        return None
 
-        return product, price_unit, uom_id
+    @api.model
+    def _determine_product_and_price(self, sale_order, employee, fallback_employee_data):
+        """
+        Returns (product_record, price_unit, uom_id)
+        - sale_order: sale.order record or False
+        - employee: hr.employee record or empty
+        - fallback_employee_data: dict returned by action_search_employee if no hr.employee exists
+
+        Batch invoicing calls it for every group once the prices of the run
+        are resolved, they are then read from the ``invoice_price_cache``
+        memo of the context (see _fill_invoice_prices).
+        """
+        product, uom_id = self._determine_invoice_product(employee, fallback_employee_data)
+        price_cache = self.env.context.get('invoice_price_cache')
+        if price_cache is None:
+            price_cache = {}
+        key = self._get_invoice_price_key(sale_order)
+        if (key, product.id) not in price_cache:
+            self._resolve_invoice_prices({key: (sale_order, {product.id: product})}, price_cache)
+        return product, price_cache[(key, product.id)], uom_id
 
     @api.model
-    def _create_invoice_line_record(self, invoice, section_id, employee_id, product, price_unit, qty, uom_id, analytic_account_id):
-        """Create a single invoice line. Returns created line record."""
-        vals = {
+    def _prepare_invoice_line_vals(self, invoice, section_id, employee_id, product, price_unit, qty, uom_id, analytic_account_id):
+        """Values of a single invoice line."""
+        return {
             'layout_category_id': section_id.id if section_id else False,
             'employee_id': employee_id.id if employee_id else False,
             'product_id': product.id,
@@ -128,67 +134,468 @@ class ProjectProject(models.Model):
             'l10n_mx_edi_sat_status': 'none',  # keep original metadata if required
             'account_analytic_id': analytic_account_id,
         }
+
+    @api.model
+    def _create_invoice_line_record(self, invoice, section_id, employee_id, product, price_unit, qty, uom_id, analytic_account_id):
+        """Create a single invoice line. Returns created line record.
+
+        Batch invoicing creates all its lines with one create(), and only goes
+        through this method, line by line, when a module overrides it.
+        """
+        vals = self._prepare_invoice_line_vals(
+            invoice, section_id, employee_id, product, price_unit, qty, uom_id, analytic_account_id)
         return self.env['account.invoice.line'].create(vals)
 
-    def create_invoice_line(self, invoice):
-        """Main entry. Iterate over projects in self and create invoice lines from timesheets."""
-        self.ensure_one()  # work per single project to avoid complexity; adapt if needed
-        project = self
-        analytic_account = project.analytic_account_id
-        if not analytic_account:
-            raise UserError(_("Project %s has no analytic account.") % project.display_name)
-
-        sale_order = self.env['sale.order'].search([('analytic_account_id', '=', analytic_account.id)], limit=1)
-        start_date, end_date = self._compute_invoice_date_range()
+    @api.model
+    def _is_invoicing_hook_overridden(self, method_name):
+        """Whether a module loaded after this one overrides the invoicing method ``method_name``."""
+        return getattr(type(self), method_name) is not getattr(ProjectProject, method_name)
+
+    @api.model
+    def _invoice_site_result(self, status, lines=None, hours=0.0, message=''):
+        """Per-site summary entry returned by create_invoice_line_multi."""
+        return {
+            'status': status,  # 'invoiced', 'nothing' or 'error'
+            'lines': lines if lines is not None else self.env['account.invoice.line'],
+            'hours': hours,
+            'message': message,
+        }
+
+    @api.model
+    def _get_invoicing_sale_orders(self, analytic_account_ids):
+        """Return {analytic_account_id: sale.order} with one search for all the accounts."""
+        sale_orders = {}
+        orders = self.env['sale.order'].search([('analytic_account_id', 'in', list(analytic_account_ids))])
+        for order in orders:
+            # keep the first one in search order, as search(..., limit=1) would
+            sale_orders.setdefault(order.analytic_account_id.id, order)
+        return sale_orders
+
+    @api.model
+    def _get_invoicing_sections(self, sale_orders):
+        """Return {analytic_account_id: [(section, task_ids), ...]} for the accounts invoiced per section.
 
-        # If analytic sections exist, aggregate per section->task set; else global aggregation
-        aggregated_groups = []
-        if sale_order and sale_order.analytic_account_id and getattr(sale_order.analytic_account_id, 'section_ids', False):
-            for section in sale_order.analytic_account_id.section_ids:
+        The descendant tasks of every section (same rules as
+        ('parent_task_id', 'child_of', okr_task) restricted to active tasks) are
+        resolved with a single recursive query. A task below several sections
+        of the same account is only assigned to the first of them in section
+        order, so its timesheets are never invoiced twice.
+        """
+        roots = []
+        sections_by_id = {}
+        # an account with sections only invoices the tasks below them, even when none has a task
+        section_tasks = {}
+        for account_id, sale_order in sale_orders.items():
+            if not (sale_order.analytic_account_id and getattr(sale_order.analytic_account_id, 'section_ids', False)):
+                continue
+            section_tasks[account_id] = []
+            for position, section in enumerate(sale_order.analytic_account_id.section_ids):
                 okr_task = getattr(section, 'task_id', False)
                 if not okr_task:
                     _logger.debug("Section %s has no task_id, skipping", section.id)
                     continue
-                task_ids = self.env['project.task'].search([('parent_task_id', 'child_of', okr_task.id), ('active', '=', True)]).ids
-                if not task_ids:
-                    continue
-                groups = self._aggregate_timesheets(analytic_account.id, start_date, end_date, task_ids=task_ids)
-                # Attach the section to each result for layout_category_id
-                for user_id, total_hours, line_ids in groups:
-                    aggregated_groups.append({
-                        'section': section,
-                        'user_id': user_id,
-                        'hours': total_hours,
-                        'line_ids': line_ids,
-                    })
+                sections_by_id[section.id] = section
+                roots.append((account_id, position, section.id, okr_task.id))
+
+        if not roots:
+            return section_tasks
+
+        self.env['project.task'].flush_model(['parent_task_id', 'active'])
+        self.env.cr.execute("""
+            WITH RECURSIVE section_tree(account_id, position, section_id, task_id) AS (
+                SELECT r.account_id, r.position, r.section_id, r.task_id
+                FROM unnest(%s::int[], %s::int[], %s::int[], %s::int[])
+                     AS r(account_id, position, section_id, task_id)
+              UNION
+                SELECT tree.account_id, tree.position, tree.section_id, t.id
+                FROM project_task t
+                JOIN section_tree tree ON t.parent_task_id = tree.task_id
+                WHERE t.active
+            )
+            SELECT DISTINCT ON (tree.account_id, tree.task_id)
+                   tree.account_id, tree.position, tree.section_id, tree.task_id
+            FROM section_tree tree
+            JOIN project_task t ON t.id = tree.task_id AND t.active
+            ORDER BY tree.account_id, tree.task_id, tree.position
+        """, (
+            [root[0] for root in roots],
+            [root[1] for root in roots],
+            [root[2] for root in roots],
+            [root[3] for root in roots],
+        ))
+        task_ids_by_section = {}
+        for account_id, position, section_id, task_id in self.env.cr.fetchall():
+            task_ids_by_section.setdefault((account_id, position, section_id), []).append(task_id)
+
+        for account_id, position, section_id, dummy in roots:
+            task_ids = task_ids_by_section.get((account_id, position, section_id))
+            if task_ids:
+                section_tasks[account_id].append((sections_by_id[section_id], task_ids))
+        return section_tasks
+
+    @api.model
+    def _get_section_map_params(self, section_tasks):
+        """Flatten {account_id: [(section, task_ids), ...]} into the arrays of the
+        ``unnest(...) AS m(account_id, task_id, section_id, position)`` mapping.
+
+        Returns (params, sections_by_id).
+        """
+        map_accounts, map_tasks, map_sections, map_positions = [], [], [], []
+        sections_by_id = {}
+        for account_id, sections in (section_tasks or {}).items():
+            for position, (section, task_ids) in enumerate(sections):
+                sections_by_id[section.id] = section
+                for task_id in task_ids:
+                    map_accounts.append(account_id)
+                    map_tasks.append(int(task_id))
+                    map_sections.append(section.id)
+                    map_positions.append(position)
+        return (map_accounts, map_tasks, map_sections, map_positions), sections_by_id
+
+    @api.model
+    def _get_timesheet_aggregation_query(self, analytic_account_ids, start_date, end_date, section_tasks=None):
+        """SQL aggregating the uninvoiced timesheets of several analytic accounts.
+
+        - section_tasks: {account_id: [(section, task_ids), ...]}; lines of those accounts
+          only count for the listed tasks and are grouped per section.
+        Returns (sql, params, sections_by_id). Rows are
+        (account_id, section_id, user_id, total_hours), ordered by account, section
+        order, then user_id (NULLs last); the lines are marked by _mark_timesheets_invoiced.
+        """
+        self.env['account.analytic.line'].flush_model([
+            'account_id', 'task_id', 'user_id', 'unit_amount', 'date', 'project_id',
+            'invoiceable_analytic_line', 'project_invoice_line_id',
+        ])
+        section_map, sections_by_id = self._get_section_map_params(section_tasks)
+        sql = """
+            SELECT l.account_id, m.section_id, l.user_id,
+                   SUM(l.unit_amount) AS total_hours
+            FROM account_analytic_line l
+            LEFT JOIN unnest(%s::int[], %s::int[], %s::int[], %s::int[])
+                      AS m(account_id, task_id, section_id, position)
+                   ON m.account_id = l.account_id AND m.task_id = l.task_id
+            WHERE l.account_id = ANY(%s::int[])
+              AND l.invoiceable_analytic_line = 't'
+              AND l.date >= %s
+              AND l.date <= %s
+              AND l.project_id IS NOT NULL
+              AND l.project_invoice_line_id IS NULL
+              AND (m.section_id IS NOT NULL OR NOT l.account_id = ANY(%s::int[]))
+            GROUP BY l.account_id, m.position, m.section_id, l.user_id
+            ORDER BY l.account_id, m.position NULLS FIRST, l.user_id ASC
+        """
+        params = section_map + (
+            list(analytic_account_ids), start_date, end_date,
+            list(section_tasks or {}),
+        )
+        return sql, params, sections_by_id
+
+    @api.model
+    def _get_whole_weeks(self, start_date, end_date):
+        """Return (first_monday, last_monday) of the whole weeks within [start_date, end_date], or (False, False)."""
+        first_monday = start_date + timedelta(days=(7 - start_date.weekday()) % 7)
+        last_monday = end_date - timedelta(days=(end_date.weekday() + 1) % 7) - timedelta(days=6)
+        if first_monday > last_monday:
+            return False, False
+        return first_monday, last_monday
+
+    @api.model
+    @instrumented('invoicing.aggregate_timesheet_totals', rows=lambda self, args, result: sum(len(groups) for groups in result.values()),
+                  ref=lambda self, args: 'accounts:%s' % ','.join(map(str, list(args[0])[:20])))
+    def _aggregate_timesheet_totals(self, analytic_account_ids, start_date, end_date, section_tasks=None):
+        """Uninvoiced hours per (section, user) read from the weekly summary table.
+
+        Whole weeks of the range come from site.timesheet.summary; only the partial
+        weeks at its edges are summed from the raw timesheets. Returns
+        {account_id: [(section, user_id, total_hours, None), ...]} ordered like
+        _get_timesheet_aggregation_query; lines are marked by _mark_timesheets_invoiced.
+        An override of _aggregate_timesheets is used instead when there is one.
+        """
+        if not analytic_account_ids:
+            return {}
+        if self._is_invoicing_hook_overridden('_aggregate_timesheets'):
+            return self._aggregate_timesheets_per_section(analytic_account_ids, start_date, end_date, section_tasks=section_tasks)
+        Summary = self.env['site.timesheet.summary']
+        self.env['account.analytic.line'].flush_model(list(SUMMARY_LINE_FIELDS))
+        Summary.flush_model()
+        section_map, sections_by_id = self._get_section_map_params(section_tasks)
+        first_monday, last_monday = self._get_whole_weeks(start_date, end_date)
+        if first_monday:
+            whole_weeks = (first_monday, last_monday + timedelta(days=6))
         else:
-            groups = self._aggregate_timesheets(analytic_account.id, start_date, end_date, task_ids=None)
-            for user_id, total_hours, line_ids in groups:
-                aggregated_groups.append({
-                    'section': False,
-                    'user_id': user_id,
-                    'hours': total_hours,
-                    'line_ids': line_ids,
-                })
-
-        if not aggregated_groups:
-            _logger.debug("No timesheets to invoice for analytic account %s", analytic_account.id)
-            return True
+            # no whole week: everything is read from the raw lines
+            whole_weeks = (end_date + timedelta(days=1), end_date)
+
+        sql = """
+            SELECT t.account_id, m.section_id, t.user_id, SUM(t.hours)
+            FROM (
+                SELECT s.account_id, s.task_id, s.user_id, s.hours
+                FROM site_timesheet_summary s
+                WHERE s.account_id = ANY(%%(account_ids)s::int[])
+                  AND s.week >= %%(first_monday)s
+                  AND s.week <= %%(last_monday)s
+              UNION ALL
+                SELECT l.account_id, l.task_id, l.user_id, l.unit_amount
+                FROM account_analytic_line l
+                WHERE l.account_id = ANY(%%(account_ids)s::int[])
+                  AND l.date >= %%(start_date)s
+                  AND l.date <= %%(end_date)s
+                  AND NOT (l.date >= %%(whole_start)s AND l.date <= %%(whole_end)s)
+                  AND %s
+            ) AS t
+            LEFT JOIN unnest(%%(map_accounts)s::int[], %%(map_tasks)s::int[], %%(map_sections)s::int[], %%(map_positions)s::int[])
+                      AS m(account_id, task_id, section_id, position)
+                   ON m.account_id = t.account_id AND m.task_id = t.task_id
+            WHERE m.section_id IS NOT NULL OR NOT t.account_id = ANY(%%(section_accounts)s::int[])
+            GROUP BY t.account_id, m.position, m.section_id, t.user_id
+            ORDER BY t.account_id, m.position NULLS FIRST, t.user_id ASC
+        """ % UNINVOICED_LINE_FILTER
+        self.env.cr.execute(sql, {
+            'account_ids': list(analytic_account_ids),
+            'first_monday': whole_weeks[0],
+            'last_monday': whole_weeks[1] - timedelta(days=6),
+            'start_date': start_date,
+            'end_date': end_date,
+            'whole_start': whole_weeks[0],
+            'whole_end': whole_weeks[1],
+            'map_accounts': section_map[0],
+            'map_tasks': section_map[1],
+            'map_sections': section_map[2],
+            'map_positions': section_map[3],
+            'section_accounts': list(section_tasks or {}),
+        })
+        results = {}
+        for account_id, section_id, user_id, total_hours in self.env.cr.fetchall():
+            section = sections_by_id[section_id] if section_id else False
+            results.setdefault(account_id, []).append((section, user_id, float(total_hours or 0.0), None))
+        return results
+
+    @api.model
+    def _aggregate_timesheets_per_section(self, analytic_account_ids, start_date, end_date, section_tasks=None):
+        """Groups of _aggregate_timesheet_totals from one _aggregate_timesheets call per account or section.
+
+        Only used when a module overrides _aggregate_timesheets: the line ids it
+        returns fill the last slot of each group, and are the lines marked by
+        _mark_timesheet_lines_invoiced.
+        """
+        results = {}
+        for account_id in analytic_account_ids:
+            if account_id in (section_tasks or {}):
+                calls = section_tasks[account_id]
+            else:
+                calls = [(False, None)]
+            groups = [
+                (section, user_id, hours, line_ids)
+                for section, task_ids in calls
+                for user_id, hours, line_ids in self._aggregate_timesheets(account_id, start_date, end_date, task_ids=task_ids)
+            ]
+            if groups:
+                results[account_id] = groups
+        return results
+
+    @api.model
+    def _mark_timesheet_lines_invoiced(self, invoice, line_ids):
+        """Link the given timesheet lines to the invoice with one UPDATE, see _aggregate_timesheets_per_section."""
+        if not line_ids:
+            return
+        AnalyticLine = self.env['account.analytic.line']
+        AnalyticLine.flush_model(list(SUMMARY_LINE_FIELDS))
+        self.env.cr.execute("""
+            UPDATE account_analytic_line
+            SET project_invoice_line_id = %s,
+                write_uid = %s,
+                write_date = (now() at time zone 'UTC')
+            WHERE id = ANY(%s::int[])
+            RETURNING account_id, task_id, user_id, date_trunc('week', date)::date
+        """, (invoice.id, self.env.uid, list(line_ids)))
+        summary_keys = set(self.env.cr.fetchall())
+        AnalyticLine.browse(line_ids).invalidate_recordset(['project_invoice_line_id', 'write_uid', 'write_date'])
+        self.env['site.timesheet.summary']._refresh_keys(summary_keys)
+
+    @api.model
+    def _mark_timesheets_invoiced(self, invoice, analytic_account_ids, start_date, end_date, section_tasks=None, group_keys=None):
+        """Link the uninvoiced timesheets of the accounts to the invoice with one UPDATE.
+
+        The lines are selected with the predicate of the aggregation (account,
+        date range, section mapping), no line id is read back. ``group_keys``
+        restricts them to some (section_id, user_id) groups. Returns the hours
+        actually marked as {account_id: [(section, user_id, total_hours, None), ...]}
+        ordered like _aggregate_timesheet_totals.
+        """
+        if not analytic_account_ids:
+            return {}
+        AnalyticLine = self.env['account.analytic.line']
+        AnalyticLine.flush_model(list(SUMMARY_LINE_FIELDS))
+        section_map, sections_by_id = self._get_section_map_params(section_tasks)
+        group_condition = ""
+        if group_keys is not None:
+            group_condition = """
+                  AND (COALESCE(m.section_id, 0), COALESCE(l.user_id, 0)) IN (
+                      SELECT * FROM unnest(%(group_sections)s::int[], %(group_users)s::int[])
+                  )"""
+        self.env.cr.execute("""
+            WITH target AS (
+                SELECT l.id, m.section_id, m.position
+                FROM account_analytic_line l
+                LEFT JOIN unnest(%%(map_accounts)s::int[], %%(map_tasks)s::int[], %%(map_sections)s::int[], %%(map_positions)s::int[])
+                          AS m(account_id, task_id, section_id, position)
+                       ON m.account_id = l.account_id AND m.task_id = l.task_id
+                WHERE l.account_id = ANY(%%(account_ids)s::int[])
+                  AND l.date >= %%(start_date)s
+                  AND l.date <= %%(end_date)s
+                  AND %s
+                  AND (m.section_id IS NOT NULL OR NOT l.account_id = ANY(%%(section_accounts)s::int[]))%s
+            ), marked AS (
+                UPDATE account_analytic_line l
+                SET project_invoice_line_id = %%(invoice_id)s,
+                    write_uid = %%(uid)s,
+                    write_date = (now() at time zone 'UTC')
+                FROM target t
+                WHERE l.id = t.id
+                RETURNING l.account_id, t.section_id, t.position, l.task_id, l.user_id, l.date, l.unit_amount
+            )
+            SELECT account_id, section_id, position, task_id, user_id, date_trunc('week', date)::date, SUM(unit_amount)
+            FROM marked
+            GROUP BY account_id, section_id, position, task_id, user_id, date_trunc('week', date)::date
+        """ % (UNINVOICED_LINE_FILTER, group_condition), {
+            'map_accounts': section_map[0],
+            'map_tasks': section_map[1],
+            'map_sections': section_map[2],
+            'map_positions': section_map[3],
+            'account_ids': list(analytic_account_ids),
+            'start_date': start_date,
+            'end_date': end_date,
+            'section_accounts': list(section_tasks or {}),
+            'invoice_id': invoice.id,
+            'uid': self.env.uid,
+            'group_sections': [section_id or 0 for section_id, dummy in group_keys or ()],
+            'group_users': [user_id or 0 for dummy, user_id in group_keys or ()],
+        })
+        summary_keys = set()
+        totals = {}
+        for account_id, section_id, position, task_id, user_id, week, hours in self.env.cr.fetchall():
+            summary_keys.add((account_id, task_id, user_id, week))
+            key = (account_id, -1 if position is None else position, section_id, user_id)
+            totals[key] = totals.get(key, 0.0) + float(hours or 0.0)
+        # no ids were read: drop the cached invoice links of every line
+        AnalyticLine.invalidate_model(['project_invoice_line_id', 'write_uid', 'write_date'])
+        self.env['site.timesheet.summary']._refresh_keys(summary_keys)
+
+        results = {}
+        # same order as the aggregation: section position (none first), then user_id (NULLs last)
+        for key in sorted(totals, key=lambda key: (key[0], key[1], key[3] is None, key[3] or 0)):
+            account_id, dummy, section_id, user_id = key
+            section = sections_by_id[section_id] if section_id else False
+            results.setdefault(account_id, []).append((section, user_id, totals[key], None))
+        return results
+
+    @api.model
+    def _mark_prepared_invoice_groups(self, invoice, prepared_by_account, start_date, end_date, section_tasks, sale_orders, resolution):
+        """Mark the timesheets of the prepared accounts and compare the marked hours with the prepared ones.
+
+        The prepared groups come from the weekly summary; an account whose marked
+        hours differ is prepared again from what was really marked. Returns
+        (prepared groups of the drifted accounts, drifted account ids); raises
+        _InvoiceGroupError when the groups of a drifted account cannot be prepared.
+        """
+        marked = self._mark_timesheets_invoiced(
+            invoice, list(prepared_by_account), start_date, end_date,
+            section_tasks={account_id: sections for account_id, sections in (section_tasks or {}).items()
+                           if account_id in prepared_by_account})
+        reprepared = {}
+        for account_id, prepared in prepared_by_account.items():
+            groups = marked.get(account_id, [])
+            expected = {(group['section'].id if group['section'] else False, group['user_id']): group['qty'] for group in prepared}
+            actual = {(section.id if section else False, user_id): hours for section, user_id, hours, dummy in groups}
+            if set(expected) == set(actual) and all(abs(actual[key] - hours) <= 0.00001 for key, hours in expected.items()):
+                continue
+            _logger.warning("Timesheet summary of analytic account %s is out of date, invoicing the marked hours", account_id)
+            try:
+                reprepared[account_id] = self._prepare_invoice_groups(sale_orders.get(account_id, False), groups, resolution)
+            except UserError as e:
+                raise _InvoiceGroupError(account_id, e.args[0])
+        return reprepared, list(reprepared)
+
+    def get_uninvoiced_hours_preview(self):
+        """What would be billed now: {project_id: {'hours': total, 'groups': [(section_id, user_id, hours), ...]}}.
+
+        Read from the weekly summary table, nothing is written.
+        """
+        projects_by_account = {}
+        for project in self.filtered('analytic_account_id'):
+            projects_by_account.setdefault(project.analytic_account_id.id, project)
+        start_date, end_date = self._compute_invoice_date_range()
+        sale_orders = self._get_invoicing_sale_orders(projects_by_account)
+        section_tasks = self._get_invoicing_sections(sale_orders)
+        totals = self._aggregate_timesheet_totals(list(projects_by_account), start_date, end_date, section_tasks=section_tasks)
+        preview = {}
+        for project in self:
+            groups = []
+            if projects_by_account.get(project.analytic_account_id.id) == project:
+                groups = totals.get(project.analytic_account_id.id, [])
+            preview[project.id] = {
+                'hours': sum(hours for dummy, dummy, hours, dummy in groups),
+                'groups': [(section.id if section else False, user_id, hours) for section, user_id, hours, dummy in groups],
+            }
+        return preview
+
+    @api.model
+    def _try_lock_invoicing_account(self, analytic_account_id, session=False):
+        """Take the advisory lock of an analytic account, so two invoicing runs cannot collide.
+
+        The lock lasts until the end of the transaction, or until
+        _unlock_invoicing_account when ``session`` is set (runs committing chunks).
+        """
+        function = 'pg_try_advisory_lock' if session else 'pg_try_advisory_xact_lock'
+        self.env.cr.execute("SELECT %s(%%s, %%s)" % function, (INVOICING_LOCK_NAMESPACE, analytic_account_id))
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def _unlock_invoicing_account(self, analytic_account_id):
+        self.env.cr.execute("SELECT pg_advisory_unlock(%s, %s)", (INVOICING_LOCK_NAMESPACE, analytic_account_id))
+
+    @api.model
+    def _get_invoicing_resolution(self, user_ids):
+        """Resolution memo shared by a whole invoicing run.
 
-        # create lines
-        created_lines = []
-        for group in aggregated_groups:
-            user_id = group['user_id']
-            qty = group['hours']
-            section = group['section']
-            line_ids = group['line_ids']
+        Maps every user_id to its employee with one search and prefetches the
+        products of their jobs. ``fallback`` memoizes action_search_employee
+        and ``prices`` the unit prices per (price key, product).
+        """
+        user_ids = set(user_ids)
+        employees_by_user = {}
+        employees = self.env['hr.employee'].search([('user_id', 'in', [uid for uid in user_ids if uid])])
+        for employee in employees:
+            # keep the first one in search order, as search(..., limit=1) would
+            employees_by_user.setdefault(employee.user_id.id, employee)
+        employees.mapped('job_id.product_inhouse_id.uom_id')
+        employees.mapped('job_id.product_outsource_id.uom_id')
+        for user_id in user_ids:
+            if user_id and user_id not in employees_by_user:
+                employees_by_user[user_id] = self.env['hr.employee'].browse()
+        return {'employees': employees_by_user, 'fallback': {}, 'prices': {}}
+
+    @api.model
+    @instrumented('invoicing.prepare_groups', rows=lambda self, args, result: len(result),
+                  ref=lambda self, args: 'sale_order:%s' % (args[0].id if args[0] else ''))
+    def _prepare_invoice_groups(self, sale_order, groups, resolution):
+        """Resolve employee and product of each aggregated group of an analytic account.
 
+        Raises UserError when the data of one group is incomplete, before anything is
+        created. Prices are filled afterwards by _fill_invoice_prices.
+        """
+        prepared = []
+        for section, user_id, qty, dummy in groups:
             # get employee record if exists
-            employee = self.env['hr.employee'].search([('user_id', '=', user_id)], limit=1)
+            employee = resolution['employees'].get(user_id)
+            if employee is None:
+                employee = self.env['hr.employee'].search([('user_id', '=', user_id)], limit=1)
             fallback_data = {}
             if not employee:
                 # custom helper expected in original code
-                fallback_data = self.action_search_employee(user_id)
+                if user_id not in resolution['fallback']:
+                    resolution['fallback'][user_id] = self.action_search_employee(user_id)
+                fallback_data = resolution['fallback'][user_id]
                 if not fallback_data:
                     raise UserError(_("Cannot find employee data for user %s") % (user_id,))
                 # fallback_data must provide 'inhouse'/'outsource' product records or ids
@@ -196,22 +603,208 @@ class ProjectProject(models.Model):
                 if 'inhouse' not in fallback_data or 'outsource' not in fallback_data:
                     raise UserError(_("Fallback employee data incomplete for user %s") % (user_id,))
 
-            # Determine product and price
-            product, price_unit, uom_id = self._determine_product_and_price(sale_order, employee, fallback_data)
-
-            created = self._create_invoice_line_record(
-                invoice=invoice,
-                section_id=section,
-                employee_id=employee,
-                product=product,
-                price_unit=price_unit,
-                qty=qty,
-                uom_id=uom_id,
-                analytic_account_id=analytic_account.id,
-            )
-            created_lines.append(created)
+            # Determine product, the price comes later in batch
+            product, uom_id = self._determine_invoice_product(employee, fallback_data)
+            prepared.append({
+                'section': section,
+                'employee': employee,
+                'product': product,
+                'price_unit': 0.0,
+                'qty': qty,
+                'uom_id': uom_id,
+                'user_id': user_id,
+                'sale_order': sale_order,
+                'fallback_data': fallback_data,
+            })
+        return prepared
+
+    @api.model
+    @instrumented('invoicing.fill_prices', rows=lambda self, args, result: len(args[0]),
+                  ref=lambda self, args: 'products:%s' % ','.join(sorted({str(group['product'].id) for group in args[0]})[:20]))
+    def _fill_invoice_prices(self, prepared, resolution):
+        """Set price_unit on prepared groups with one pricelist call per (pricelist, partner, date).
+
+        Product, price and unit of every group then go through
+        _determine_product_and_price, which reads the resolved prices.
+        """
+        price_cache = resolution['prices']
+        todo = {}
+        for group in prepared:
+            key = self._get_invoice_price_key(group['sale_order'])
+            if (key, group['product'].id) not in price_cache:
+                sale_order, products = todo.setdefault(key, (group['sale_order'], {}))
+                products[group['product'].id] = group['product']
+        self._resolve_invoice_prices(todo, price_cache)
+
+        Project = self.with_context(invoice_price_cache=price_cache)
+        for group in prepared:
+            group['product'], group['price_unit'], group['uom_id'] = Project._determine_product_and_price(
+                group['sale_order'], group['employee'], group['fallback_data'])
+
+    @api.model
+    def _resolve_invoice_prices(self, todo, price_cache):
+        """Fill ``price_cache`` for ``todo`` = {price key: (sale_order, {product_id: product})}, one call per key."""
+        for key, (sale_order, products) in todo.items():
+            products = self.env['product.product'].browse(list(products))
+            if key is None:
+                for product in products:
+                    price_cache[(key, product.id)] = product.list_price
+                continue
+            pricelist = sale_order.pricelist_id.with_context(lang=sale_order.partner_id.lang)
+            if hasattr(pricelist, '_get_products_price'):
+                # 16.0: prices no longer depend on the partner
+                prices = pricelist._get_products_price(products, 1.0, date=sale_order.date_order)
+            else:
+                prices = pricelist.get_products_price(
+                    products, [1.0] * len(products), [sale_order.partner_id] * len(products),
+                    date=sale_order.date_order,
+                )
+            for product in products:
+                price_cache[(key, product.id)] = prices.get(product.id, product.list_price)
+
+    @api.model
+    def _create_prepared_invoice_lines(self, invoice, prepared_by_account):
+        """Create the lines of prepared groups with a single create(), their timesheets are marked by the caller.
 
-            if line_ids:
-                self.env['account.analytic.line'].browse(line_ids).write({'project_invoice_line_id': invoice.id})
+        Returns {account_id: created lines}.
+        """
+        if self._is_invoicing_hook_overridden('_create_invoice_line_record'):
+            InvoiceLine = self.env['account.invoice.line']
+            return {
+                account_id: InvoiceLine.concat(*[self._create_invoice_line_record(
+                    invoice=invoice,
+                    section_id=group['section'],
+                    employee_id=group['employee'],
+                    product=group['product'],
+                    price_unit=group['price_unit'],
+                    qty=group['qty'],
+                    uom_id=group['uom_id'],
+                    analytic_account_id=account_id,
+                ) for group in prepared])
+                for account_id, prepared in prepared_by_account.items()
+            }
+        vals_list = []
+        for account_id, prepared in prepared_by_account.items():
+            for group in prepared:
+                vals_list.append(self._prepare_invoice_line_vals(
+                    invoice=invoice,
+                    section_id=group['section'],
+                    employee_id=group['employee'],
+                    product=group['product'],
+                    price_unit=group['price_unit'],
+                    qty=group['qty'],
+                    uom_id=group['uom_id'],
+                    analytic_account_id=account_id,
+                ))
+        created_lines = self.env['account.invoice.line'].create(vals_list)
+
+        created_by_account = {}
+        offset = 0
+        for account_id, prepared in prepared_by_account.items():
+            created_by_account[account_id] = created_lines[offset:offset + len(prepared)]
+            offset += len(prepared)
+        return created_by_account
+
+    @instrumented('invoicing.create_invoice_line_multi', rows=lambda self, args, result: len(self),
+                  ref=lambda self, args: 'accounts:%s' % ','.join(map(str, self.analytic_account_id.ids[:20])))
+    def create_invoice_line_multi(self, invoice):
+        """Create invoice lines from timesheets for every project in self at once.
+
+        Timesheets are aggregated with one query for all analytic accounts and the
+        sale orders are resolved with one search. Returns {project_id: summary}
+        (see _invoice_site_result); a site in error creates nothing and does not
+        stop the others.
+        """
+        results = {}
+        projects_by_account = {}
+        for project in self:
+            analytic_account = project.analytic_account_id
+            if not analytic_account:
+                results[project.id] = self._invoice_site_result(
+                    'error', message=_("Project %s has no analytic account.") % project.display_name)
+                continue
+            if analytic_account.id not in projects_by_account and not self._try_lock_invoicing_account(analytic_account.id):
+                results[project.id] = self._invoice_site_result(
+                    'error', message=_("Analytic account %s is being invoiced by another run.") % analytic_account.display_name)
+                continue
+            projects_by_account.setdefault(analytic_account.id, []).append(project)
+        if not projects_by_account:
+            return results
+
+        start_date, end_date = self._compute_invoice_date_range()
+        sale_orders = self._get_invoicing_sale_orders(projects_by_account)
+        section_tasks = self._get_invoicing_sections(sale_orders)
+        # totals come from the weekly summary, the raw lines are only touched by the marking
+        groups_by_account = self._aggregate_timesheet_totals(
+            list(projects_by_account), start_date, end_date, section_tasks=section_tasks)
+        resolution = self._get_invoicing_resolution(
+            user_id for groups in groups_by_account.values() for dummy, user_id, dummy, dummy in groups)
+
+        prepared_by_account = {}
+        for account_id, projects in projects_by_account.items():
+            # sites sharing an analytic account: the first one invoices it
+            for other in projects[1:]:
+                results[other.id] = self._invoice_site_result('nothing')
+            project = projects[0]
+            if project.id in results:
+                continue
+            # accounts without summary groups are marked too, in case the summary missed their lines
+            try:
+                prepared_by_account[account_id] = self._prepare_invoice_groups(
+                    sale_orders.get(account_id, False), groups_by_account.get(account_id, []), resolution)
+            except UserError as e:
+                results[project.id] = self._invoice_site_result('error', message=e.args[0])
 
-        return created_lines
+        if self._is_invoicing_hook_overridden('_aggregate_timesheets'):
+            # the override chose the lines of each group, those are the ones invoiced
+            self._mark_timesheet_lines_invoiced(invoice, [
+                line_id for account_id in prepared_by_account
+                for dummy, dummy, dummy, line_ids in groups_by_account.get(account_id, [])
+                for line_id in line_ids
+            ])
+        else:
+            drifted = []
+            while prepared_by_account:
+                try:
+                    with self.env.cr.savepoint():
+                        reprepared, drifted = self._mark_prepared_invoice_groups(
+                            invoice, prepared_by_account, start_date, end_date, section_tasks, sale_orders, resolution)
+                    prepared_by_account.update(reprepared)
+                    break
+                except _InvoiceGroupError as e:
+                    # the savepoint undid the marking, mark again without this account
+                    account_id, message = e.args
+                    results[projects_by_account[account_id][0].id] = self._invoice_site_result('error', message=message)
+                    prepared_by_account.pop(account_id)
+            if drifted:
+                Summary = self.env['site.timesheet.summary']
+                Summary._refresh_keys(Summary._get_keys_of_accounts(drifted, start_date, end_date))
+
+        for account_id, prepared in list(prepared_by_account.items()):
+            if not prepared:
+                _logger.debug("No timesheets to invoice for analytic account %s", account_id)
+                results[projects_by_account[account_id][0].id] = self._invoice_site_result('nothing')
+                prepared_by_account.pop(account_id)
+
+        self._fill_invoice_prices(
+            [group for prepared in prepared_by_account.values() for group in prepared], resolution)
+
+        created_by_account = self._create_prepared_invoice_lines(invoice, prepared_by_account)
+        for account_id, prepared in prepared_by_account.items():
+            project = projects_by_account[account_id][0]
+            results[project.id] = self._invoice_site_result(
+                'invoiced', lines=created_by_account[account_id],
+                hours=sum(group['qty'] for group in prepared))
+        return results
+
+    @instrumented('invoicing.create_invoice_line', rows=lambda self, args, result: len(result) if isinstance(result, list) else 0,
+                  ref=lambda self, args: 'account:%s' % self.analytic_account_id.id)
+    def create_invoice_line(self, invoice):
+        """Main entry. Create invoice lines from timesheets for a single project."""
+        self.ensure_one()  # see create_invoice_line_multi to invoice several projects at once
+        result = self.create_invoice_line_multi(invoice)[self.id]
+        if result['status'] == 'error':
+            raise UserError(result['message'])
+        if result['status'] == 'nothing':
+            return True
+        return list(result['lines'])
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import api, fields, models, tools
+
+_logger = logging.getLogger(__name__)
+
+# account.analytic.line fields the summary depends on
+SUMMARY_LINE_FIELDS = {
+    'account_id', 'task_id', 'user_id', 'date', 'unit_amount', 'project_id',
+    'invoiceable_analytic_line', 'project_invoice_line_id',
+}
+
+# uninvoiced invoiceable timesheets, the only lines kept in the summary
+UNINVOICED_LINE_FILTER = """
+    l.invoiceable_analytic_line = 't'
+    AND l.project_id IS NOT NULL
+    AND l.project_invoice_line_id IS NULL
+"""
+
+
+class SiteTimesheetSummary(models.Model):
+    _name = "site.timesheet.summary"
+    _description = "Uninvoiced Timesheet Hours per Week"
+    _order = "week desc, account_id, task_id, user_id"
+    _log_access = False
+
+    account_id = fields.Many2one('account.analytic.account', string="Analytic Account", required=True, ondelete='cascade', index=True)
+    task_id = fields.Many2one('project.task', string="Milestone", ondelete='cascade')
+    user_id = fields.Many2one('res.users', string="User", ondelete='cascade')
+    week = fields.Date(string="Week", required=True, help="Monday of the week")
+    hours = fields.Float(string="Hours")
+    line_count = fields.Integer(string="Timesheet Lines")
+
+    def init(self):
+        # task_id and user_id may be NULL, the key must still be unique
+        tools.create_unique_index(
+            self.env.cr, 'site_timesheet_summary_key_uniq', self._table,
+            ['account_id', 'week', 'COALESCE(task_id, 0)', 'COALESCE(user_id, 0)'])
+        if self._is_enabled():
+            self.env.cr.execute("SELECT 1 FROM site_timesheet_summary LIMIT 1")
+            if not self.env.cr.fetchone():
+                self._rebuild()
+
+    @api.model
+    @tools.ormcache()
+    def _is_enabled(self):
+        """Whether account.analytic.line has every stored field of the summary.
+
+        Some of them (invoiceable_analytic_line, project_invoice_line_id, task_id)
+        come from modules of the customer database this module does not depend
+        on; without them the summary and its hooks do nothing.
+        """
+        line_fields = self.env['account.analytic.line']._fields
+        return all(fname in line_fields and line_fields[fname].store for fname in SUMMARY_LINE_FIELDS)
+
+    @api.model
+    def _flush_lines(self):
+        AnalyticLine = self.env['account.analytic.line']
+        AnalyticLine.flush_model(list(SUMMARY_LINE_FIELDS & set(AnalyticLine._fields)))
+
+    @api.model
+    def _get_keys_of_lines(self, line_ids):
+        """Return the set of (account_id, task_id, user_id, week) keys of analytic lines."""
+        if not line_ids or not self._is_enabled():
+            return set()
+        self.env.cr.execute("""
+            SELECT DISTINCT account_id, task_id, user_id, date_trunc('week', date)::date
+            FROM account_analytic_line
+            WHERE id = ANY(%s)
+        """, (list(line_ids),))
+        return set(self.env.cr.fetchall())
+
+    @api.model
+    def _get_keys_of_accounts(self, account_ids, date_from, date_to):
+        """Return the keys of the summary rows of analytic accounts whose week overlaps [date_from, date_to]."""
+        if not account_ids:
+            return set()
+        self.flush_model()
+        self.env.cr.execute("""
+            SELECT account_id, task_id, user_id, week
+            FROM site_timesheet_summary
+            WHERE account_id = ANY(%s)
+              AND week >= date_trunc('week', %s::date)::date
+              AND week <= %s
+        """, (list(account_ids), date_from, date_to))
+        return set(self.env.cr.fetchall())
+
+    @api.model
+    def _refresh_keys(self, keys):
+        """Recompute the summary rows of the given keys from the raw lines, and only those."""
+        keys = [key for key in keys if key[0]]
+        if not keys or not self._is_enabled():
+            return
+        self._flush_lines()
+        self.flush_model()
+        params = (
+            [key[0] for key in keys],
+            [key[1] for key in keys],
+            [key[2] for key in keys],
+            [key[3] for key in keys],
+        )
+        self.env.cr.execute("""
+            DELETE FROM site_timesheet_summary s
+            USING unnest(%s::int[], %s::int[], %s::int[], %s::date[]) AS k(account_id, task_id, user_id, week)
+            WHERE s.account_id = k.account_id
+              AND s.task_id IS NOT DISTINCT FROM k.task_id
+              AND s.user_id IS NOT DISTINCT FROM k.user_id
+              AND s.week = k.week
+        """, params)
+        self.env.cr.execute("""
+            INSERT INTO site_timesheet_summary (account_id, task_id, user_id, week, hours, line_count)
+            SELECT l.account_id, l.task_id, l.user_id, k.week, SUM(l.unit_amount), COUNT(*)
+            FROM (
+                SELECT DISTINCT * FROM unnest(%%s::int[], %%s::int[], %%s::int[], %%s::date[])
+            ) AS k(account_id, task_id, user_id, week)
+            JOIN account_analytic_line l
+              ON l.account_id = k.account_id
+             AND l.task_id IS NOT DISTINCT FROM k.task_id
+             AND l.user_id IS NOT DISTINCT FROM k.user_id
+             AND l.date >= k.week
+             AND l.date < k.week + 7
+            WHERE %s
+            GROUP BY l.account_id, l.task_id, l.user_id, k.week
+        """ % UNINVOICED_LINE_FILTER, params)
+        self.invalidate_model()
+
+    @api.model
+    def _get_live_aggregation_query(self):
+        return """
+            SELECT l.account_id, l.task_id, l.user_id, date_trunc('week', l.date)::date AS week,
+                   SUM(l.unit_amount) AS hours, COUNT(*) AS line_count
+            FROM account_analytic_line l
+            WHERE %s
+            GROUP BY l.account_id, l.task_id, l.user_id, date_trunc('week', l.date)::date
+        """ % UNINVOICED_LINE_FILTER
+
+    @api.model
+    def _rebuild(self):
+        """Rebuild the whole summary from the raw timesheets."""
+        if not self._is_enabled():
+            return
+        self._flush_lines()
+        self.env.cr.execute("DELETE FROM site_timesheet_summary")
+        self.env.cr.execute("""
+            INSERT INTO site_timesheet_summary (account_id, task_id, user_id, week, hours, line_count)
+            %s
+        """ % self._get_live_aggregation_query())
+        self.invalidate_model()
+
+    @api.model
+    def _check_consistency(self):
+        """Diff the summary against the live aggregation of the raw timesheets.
+
+        Returns a list of (account_id, task_id, user_id, week, summary_hours, live_hours)
+        for every key that differs; an empty list means the summary is up to date.
+        """
+        if not self._is_enabled():
+            return []
+        self._flush_lines()
+        self.flush_model()
+        self.env.cr.execute("""
+            SELECT COALESCE(s.account_id, live.account_id),
+                   COALESCE(s.task_id, live.task_id),
+                   COALESCE(s.user_id, live.user_id),
+                   COALESCE(s.week, live.week),
+                   s.hours, live.hours
+            FROM site_timesheet_summary s
+            FULL OUTER JOIN (%s) AS live
+              ON live.account_id = s.account_id
+             AND live.task_id IS NOT DISTINCT FROM s.task_id
+             AND live.user_id IS NOT DISTINCT FROM s.user_id
+             AND live.week = s.week
+            WHERE s.id IS NULL
+               OR live.account_id IS NULL
+               OR ABS(s.hours - live.hours) > 0.00001
+               OR s.line_count != live.line_count
+        """ % self._get_live_aggregation_query())
+        return self.env.cr.fetchall()
+
+    @api.model
+    def _cron_check_consistency(self):
+        """Rebuild the summary when it drifted from the raw timesheets."""
+        differences = self._check_consistency()
+        if differences:
+            _logger.warning("Timesheet summary out of date on %s keys (e.g. %s), rebuilding", len(differences), differences[:5])
+            self._rebuild()
+
+
+class AccountAnalyticLine(models.Model):
+    _inherit = "account.analytic.line"
+
+    def _refresh_timesheet_summary(self, keys=None):
+        """Refresh the summary rows of these lines, plus the ``keys`` they had before a change."""
+        Summary = self.env['site.timesheet.summary']
+        self.flush_recordset(list(SUMMARY_LINE_FIELDS & set(self._fields)))
+        keys = set(keys or ()) | Summary._get_keys_of_lines(self.ids)
+        Summary._refresh_keys(keys)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        lines = super(AccountAnalyticLine, self).create(vals_list)
+        if self.env['site.timesheet.summary']._is_enabled():
+            lines._refresh_timesheet_summary()
+        return lines
+
+    def write(self, vals):
+        Summary = self.env['site.timesheet.summary']
+        if not SUMMARY_LINE_FIELDS & set(vals) or not Summary._is_enabled():
+            return super(AccountAnalyticLine, self).write(vals)
+        self.flush_recordset(list(SUMMARY_LINE_FIELDS & set(self._fields)))
+        keys_before = Summary._get_keys_of_lines(self.ids)
+        res = super(AccountAnalyticLine, self).write(vals)
+        self._refresh_timesheet_summary(keys_before)
+        return res
+
+    def unlink(self):
+        Summary = self.env['site.timesheet.summary']
+        if not Summary._is_enabled():
+            return super(AccountAnalyticLine, self).unlink()
+        self.flush_recordset(list(SUMMARY_LINE_FIELDS & set(self._fields)))
+        keys_before = Summary._get_keys_of_lines(self.ids)
+        res = super(AccountAnalyticLine, self).unlink()
+        Summary._refresh_keys(keys_before)
+        return res
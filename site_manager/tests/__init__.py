@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+from . import test_site_fields
+from . import test_requirements
+from . import test_invoicing
+from . import test_query_plans
+from . import test_benchmark
+from . import test_site_import
+from . import test_deadline_escalation
+from . import test_portfolio_summary
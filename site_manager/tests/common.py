@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import random
+from datetime import date, timedelta
+
+from odoo import tools
+
+# stored project.project fields used as mandatory fields by generated requirements
+MANDATORY_FIELD_CANDIDATES = [
+    'partner_id', 'user_id', 'date_start', 'date', 'description', 'tag_ids',
+    'deadline_date', 'budget', 'project_size', 'stage_site_id', 'analytic_account_id',
+]
+
+
+class SiteDataGenerator(object):
+    """Seeded generator of synthetic site data for benchmarks and volume tests.
+
+    The same seed always produces the same data set. Large volumes are
+    inserted by cloning a template row in SQL instead of going through the ORM.
+    """
+
+    def __init__(self, env, seed=42):
+        self.env = env
+        self.random = random.Random(seed)
+
+    def clone_rows(self, table, template_id, count, overrides=None):
+        """Insert ``count`` copies of row ``template_id``; ``overrides`` maps columns to SQL expressions of g (1..count)."""
+        overrides = overrides or {}
+        cr = self.env.cr
+        cr.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_name = %s AND column_name != 'id'
+        """, (table,))
+        columns = [row[0] for row in cr.fetchall() if row[0] not in overrides]
+        cr.execute('INSERT INTO "{table}" ({names}) SELECT {values} FROM "{table}" t, generate_series(1, {count}) AS g WHERE t.id = {template} RETURNING id'.format(
+            table=table,
+            names=', '.join('"%s"' % column for column in columns + list(overrides)),
+            values=', '.join(['t."%s"' % column for column in columns] + list(overrides.values())),
+            count=int(count),
+            template=int(template_id),
+        ))
+        ids = [row[0] for row in cr.fetchall()]
+        cr.execute('ANALYZE "%s"' % table)
+        return ids
+
+    @staticmethod
+    def sql_pick(ids, expression='g'):
+        """SQL expression picking one of ``ids`` from ``expression``, deterministically."""
+        return '(ARRAY[%s])[1 + (%s) %% %s]' % (', '.join(str(int(i)) for i in ids), expression, len(ids))
+
+    def create_milestones(self, count):
+        """Milestones (project.task) used as requirement stages."""
+        project = self.env['project.project'].create({'name': 'Benchmark Milestones'})
+        return self.env['project.task'].create([
+            {'name': 'Milestone %s' % i, 'project_id': project.id} for i in range(count)
+        ])
+
+    def create_requirement(self, milestones, lines_count, fields_per_line):
+        """Requirement with ``lines_count`` lines spread over milestones, each with ``fields_per_line`` mandatory fields."""
+        IrField = self.env['ir.model.fields']
+        candidates = IrField.search([
+            ('model', '=', 'project.project'),
+            ('name', 'in', MANDATORY_FIELD_CANDIDATES),
+        ])
+        requirement = self.env['dynamic.requirement.field'].create({'name': 'Benchmark Requirement', 'type': 'site'})
+        self.env['dynamic.requirement.field.line'].create([{
+            'requirement_id': requirement.id,
+            'sequence': i,
+            'stage_id': milestones[i % len(milestones)].id,
+            'mandatory_fields': [(6, 0, self.random.sample(candidates.ids, min(fields_per_line, len(candidates))))],
+        } for i in range(lines_count)])
+        return requirement
+
+    def create_sites(self, count, requirement=False, filled_ratio=0.5):
+        """``count`` sites; about ``filled_ratio`` of them have every candidate field filled."""
+        Project = self.env['project.project']
+        partner = self.env['res.partner'].create({'name': 'Benchmark Customer'})
+        tag = self.env['project.tags'].create({'name': 'Benchmark'})
+        filled = Project.create({
+            'name': 'Benchmark Site Filled',
+            'requirement_id': requirement.id if requirement else False,
+            'partner_id': partner.id,
+            'user_id': self.env.uid,
+            'date_start': date.today(),
+            'date': date.today() + timedelta(days=90),
+            'description': 'Filled',
+            'tag_ids': [(6, 0, tag.ids)],
+            'deadline_date': date.today() + timedelta(days=90),
+            'budget': 1000.0,
+            'project_size': 'medium',
+        })
+        empty = Project.create({
+            'name': 'Benchmark Site Empty',
+            'requirement_id': requirement.id if requirement else False,
+        })
+        filled_count = int(count * filled_ratio)
+        ids = self.clone_rows('project_project', filled.id, max(filled_count - 1, 0))
+        ids += self.clone_rows('project_project', empty.id, max(count - filled_count - 1, 0))
+        # many2many values are not part of the cloned rows
+        if ids:
+            self.env.cr.execute("""
+                INSERT INTO project_project_project_tags_rel (project_project_id, project_tags_id)
+                SELECT p.id, %s FROM project_project p
+                WHERE p.id = ANY(%s) AND p.description IS NOT NULL
+            """, (tag.id, ids))
+        return Project.browse([filled.id, empty.id] + ids)
+
+    def create_section_tree(self, analytic_account, sections_count, depth, breadth):
+        """Task trees below ``sections_count`` section tasks; returns {section task: all its task ids}."""
+        if not tools.column_exists(self.env.cr, 'project_task', 'parent_task_id'):
+            return {}
+        Task = self.env['project.task']
+        project = self.env['project.project'].create({'name': 'Benchmark Sections', 'analytic_account_id': analytic_account.id})
+        trees = {}
+        for s in range(sections_count):
+            root = Task.create({'name': 'Section %s' % s, 'project_id': project.id})
+            level = root
+            all_ids = [root.id]
+            for d in range(depth):
+                level = Task.create([
+                    {'name': 'Task %s/%s/%s' % (s, d, b), 'project_id': project.id, 'parent_task_id': parent.id}
+                    for parent in level for b in range(breadth)
+                ])
+                all_ids += level.ids
+            trees[root] = all_ids
+        return trees
+
+    def create_timesheets(self, analytic_accounts, users, count, task_ids=None, days=120):
+        """``count`` uninvoiced invoiceable timesheets spread over accounts, users, tasks and ``days`` days."""
+        AnalyticLine = self.env['account.analytic.line']
+        project = self.env['project.project'].search([('analytic_account_id', '=', analytic_accounts[0].id)], limit=1)
+        if not project:
+            project = self.env['project.project'].create({'name': 'Benchmark Timesheets', 'analytic_account_id': analytic_accounts[0].id})
+        template = AnalyticLine.create({
+            'name': 'Benchmark', 'account_id': analytic_accounts[0].id, 'project_id': project.id,
+            'user_id': users[0].id, 'unit_amount': 1.0, 'date': date.today(), 'invoiceable_analytic_line': True,
+        })
+        overrides = {
+            'account_id': self.sql_pick(analytic_accounts.ids),
+            'user_id': self.sql_pick(users.ids, 'g / %s' % len(analytic_accounts)),
+            'date': 'current_date - (g %% %s)' % int(days),
+            'unit_amount': '0.25 * (1 + g % 16)',
+        }
+        if task_ids:
+            overrides['task_id'] = self.sql_pick(task_ids, 'g / 7')
+        ids = self.clone_rows('account_analytic_line', template.id, count - 1, overrides)
+        # the rows were inserted in SQL, bring the summary table up to date
+        self.env['site.timesheet.summary']._rebuild()
+        return [template.id] + ids
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of stage validation and invoicing on synthetic data.
+
+Not part of the standard test run, launch them with
+``--test-tags site_manager_benchmark``. Volumes and outputs are driven by
+environment variables:
+
+- SITE_MANAGER_BENCH_SITES, _REQUIREMENT_LINES, _FIELDS_PER_LINE, _TIMESHEETS,
+  _USERS, _SECTIONS: data set size
+- SITE_MANAGER_BENCH_REPORT: path of the JSON report to write
+- SITE_MANAGER_BENCH_BASELINE: JSON report to compare with; the run fails
+  when a scenario runs more queries than the baseline, or is slower or uses
+  more memory beyond SITE_MANAGER_BENCH_TOLERANCE (default 0.25, i.e. +25%)
+"""
+import json
+import logging
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from odoo import tools
+from odoo.tests.common import TransactionCase, tagged
+
+from .common import SiteDataGenerator
+
+_logger = logging.getLogger(__name__)
+
+
+def _env_int(name, default):
+    return int(os.environ.get('SITE_MANAGER_BENCH_%s' % name, default))
+
+
+@tagged('-standard', '-at_install', 'post_install', 'site_manager_benchmark')
+class TestSiteManagerBenchmark(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestSiteManagerBenchmark, cls).setUpClass()
+        cls.report = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        path = os.environ.get('SITE_MANAGER_BENCH_REPORT')
+        if path and cls.report:
+            with open(path, 'w') as report_file:
+                json.dump(cls.report, report_file, indent=2, sort_keys=True)
+            _logger.info("Benchmark report written to %s", path)
+        super(TestSiteManagerBenchmark, cls).tearDownClass()
+
+    def setUp(self):
+        super(TestSiteManagerBenchmark, self).setUp()
+        self.generator = SiteDataGenerator(self.env, seed=_env_int('SEED', 42))
+
+    @contextmanager
+    def measure(self, scenario, **parameters):
+        """Measure wall time, query count and peak Python memory of the block, then check the baseline."""
+        self.env.flush_all()
+        self.env.invalidate_all()
+        tracemalloc.start()
+        queries = self.cr.sql_log_count
+        started = time.perf_counter()
+        try:
+            yield
+            self.env.flush_all()
+        finally:
+            wall_time = time.perf_counter() - started
+            dummy, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        result = {
+            'parameters': parameters,
+            'wall_time': round(wall_time, 4),
+            'queries': self.cr.sql_log_count - queries,
+            'peak_memory_kb': round(peak / 1024.0, 1),
+        }
+        self.report[scenario] = result
+        _logger.info("Benchmark %s: %s", scenario, json.dumps(result, sort_keys=True))
+        self._check_baseline(scenario, result)
+
+    def _check_baseline(self, scenario, result):
+        path = os.environ.get('SITE_MANAGER_BENCH_BASELINE')
+        if not path or not os.path.exists(path):
+            return
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file).get(scenario)
+        if not baseline or baseline.get('parameters') != result['parameters']:
+            return
+        tolerance = 1.0 + float(os.environ.get('SITE_MANAGER_BENCH_TOLERANCE', 0.25))
+        self.assertLessEqual(result['queries'], baseline['queries'],
+                             "%s: query count regressed" % scenario)
+        self.assertLessEqual(result['wall_time'], baseline['wall_time'] * tolerance,
+                             "%s: wall time regressed" % scenario)
+        self.assertLessEqual(result['peak_memory_kb'], baseline['peak_memory_kb'] * tolerance,
+                             "%s: peak memory regressed" % scenario)
+
+    def test_stage_validation(self):
+        """Validación de requirements al mover muchos sites de milestone."""
+        sites_count = _env_int('SITES', 10000)
+        lines_count = _env_int('REQUIREMENT_LINES', 200)
+        fields_count = _env_int('FIELDS_PER_LINE', 5)
+        milestones = self.generator.create_milestones(min(lines_count, 50))
+        requirement = self.generator.create_requirement(milestones, lines_count, fields_count)
+        sites = self.generator.create_sites(sites_count, requirement=requirement)
+
+        with self.measure('stage_validation', sites=sites_count, lines=lines_count, fields=fields_count):
+            violations = sites._collect_stage_violations(milestones[0])
+        self.assertLessEqual(len(violations), len(sites))
+
+        with self.measure('stage_validation_single', lines=lines_count, fields=fields_count):
+            for site in sites[:100]:
+                self.env['project.project']._check_record_mandatory_for_stage(site, milestones[-1])
+
+    def _setup_invoicing(self):
+        if not tools.column_exists(self.cr, 'account_analytic_line', 'invoiceable_analytic_line'):
+            self.skipTest("account_analytic_line has no invoiceable_analytic_line")
+        if 'account.invoice' not in self.env or 'product_inhouse_id' not in self.env['hr.job']._fields:
+            self.skipTest("Legacy invoicing models are not available")
+        sites_count = min(_env_int('SITES', 10000), 400)
+        users_count = _env_int('USERS', 50)
+        product = self.env['product.product'].create({'name': 'Benchmark Hour', 'list_price': 40.0})
+        job = self.env['hr.job'].create({
+            'name': 'Benchmark Consultant', 'product_inhouse_id': product.id, 'product_outsource_id': product.id,
+        })
+        users = self.env['res.users'].create([
+            {'name': 'Benchmark User %s' % i, 'login': 'bench_user_%s' % i} for i in range(users_count)
+        ])
+        self.env['hr.employee'].create([{'name': u.name, 'user_id': u.id, 'job_id': job.id} for u in users])
+        accounts = self.env['account.analytic.account'].create([
+            {'name': 'Benchmark Account %s' % i} for i in range(sites_count)
+        ])
+        sites = self.env['project.project'].create([
+            {'name': 'Benchmark Invoiced Site %s' % i, 'analytic_account_id': account.id}
+            for i, account in enumerate(accounts)
+        ])
+        # timesheets are spread over task trees, as they are below invoicing sections
+        trees = self.generator.create_section_tree(accounts[0], _env_int('SECTIONS', 50), depth=3, breadth=3)
+        task_ids = [task_id for ids in trees.values() for task_id in ids]
+        self.generator.create_timesheets(accounts, users, _env_int('TIMESHEETS', 1000000), task_ids=task_ids)
+        partner = self.env['res.partner'].create({'name': 'Benchmark Invoiced Customer'})
+        invoice = self.env['account.invoice'].create({'partner_id': partner.id})
+        return sites, invoice
+
+    def test_invoicing(self):
+        """Facturación de muchos sites con muchas líneas de horas."""
+        sites, invoice = self._setup_invoicing()
+        timesheets = _env_int('TIMESHEETS', 1000000)
+        with self.measure('invoicing_preview', sites=len(sites), timesheets=timesheets):
+            sites.get_uninvoiced_hours_preview()
+        with self.measure('invoicing_batch', sites=len(sites), timesheets=timesheets):
+            results = sites.create_invoice_line_multi(invoice)
+        self.assertFalse([r for r in results.values() if r['status'] == 'error'])
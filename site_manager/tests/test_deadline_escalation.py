@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from odoo import fields
+from odoo.tests.common import TransactionCase
+
+
+class TestDeadlineEscalation(TransactionCase):
+
+    def setUp(self):
+        super(TestDeadlineEscalation, self).setUp()
+        self.Watermark = self.env['site.deadline.watermark']
+        self.Project = self.env['project.project']
+        self.now = fields.Datetime.now()
+
+    def _activities(self, site):
+        return self.env['mail.activity'].search([('res_model', '=', 'project.project'), ('res_id', '=', site.id)])
+
+    def test_cron_escalates_crossed_deadlines_once(self):
+        """El cron escala cada site una sola vez por nivel cuando su deadline cruza el umbral."""
+        self.Watermark._cron_escalate_deadlines(now=self.now)
+        site = self.Project.create({
+            'name': 'Site Escalation', 'project_size': 'large', 'deadline_date': self.now + timedelta(days=60),
+        })
+        self.assertFalse(site.deadline_escalation)
+
+        # large sites are escalated 30 days before their deadline
+        self.Watermark._cron_escalate_deadlines(now=self.now + timedelta(days=31))
+        self.assertEqual(site.deadline_escalation, 'near')
+        self.assertEqual(len(self._activities(site)), 1)
+
+        self.Watermark._cron_escalate_deadlines(now=self.now + timedelta(days=32))
+        self.assertEqual(len(self._activities(site)), 1)
+
+        self.Watermark._cron_escalate_deadlines(now=self.now + timedelta(days=61))
+        self.assertEqual(site.deadline_escalation, 'overdue')
+        self.assertEqual(len(self._activities(site)), 2)
+
+    def test_deadline_moved_into_the_past_is_escalated(self):
+        """Un deadline movido al pasado se escala al escribirlo; moverlo más tarde reinicia el nivel."""
+        site = self.Project.create({'name': 'Site Moved', 'deadline_date': self.now + timedelta(days=90)})
+        site.deadline_date = self.now - timedelta(days=1)
+        self.assertEqual(site.deadline_escalation, 'overdue')
+        self.assertEqual(len(self._activities(site)), 1)
+
+        site.deadline_date = self.now + timedelta(days=90)
+        self.assertFalse(site.deadline_escalation)
+
+    def _set_deadline_in_db(self, sites, deadline):
+        """Deadline written behind the ORM, as for sites that existed before the escalation."""
+        sites.flush_recordset()
+        self.env.cr.execute("UPDATE project_project SET deadline_date = %s WHERE id = ANY(%s)", (deadline, sites.ids))
+        sites.invalidate_recordset(['deadline_date'])
+
+    def test_new_watermark_escalates_backlog(self):
+        """Un watermark nuevo recorre el backlog por lotes: los sites ya vencidos también se escalan."""
+        self.env['ir.config_parameter'].sudo().set_param('site_manager.deadline_batch_size', '2')
+        sites = self.Project.create([
+            {'name': 'Site Backlog %s' % i, 'project_size': 'medium', 'deadline_date': self.now + timedelta(days=90)}
+            for i in range(5)
+        ])
+        self._set_deadline_in_db(sites, self.now - timedelta(days=3))
+        self.Watermark.search([]).unlink()
+
+        self.Watermark._cron_escalate_deadlines(now=self.now)
+        self.assertEqual(set(sites.mapped('deadline_escalation')), {'overdue'})
+        # one overdue activity per site, no 'near' activity on a past deadline
+        for site in sites:
+            activities = self._activities(site)
+            self.assertEqual(len(activities), 1)
+            self.assertIn('overdue', activities.summary.lower())
+        watermark = self.Watermark.search([('level', '=', 'overdue'), ('project_size', '=', 'medium')])
+        self.assertGreaterEqual(watermark.last_deadline, self.now - timedelta(days=3))
+
+    def test_closed_milestone_is_escalated_when_reopened(self):
+        """Un site en un milestone cerrado no se escala ni queda atrás del watermark: se escala al reabrirlo."""
+        closed = self.env['project.task.type'].create({'name': 'Closed', 'fold': True})
+        open_stage = self.env['project.task.type'].create({'name': 'Open'})
+        milestones = self.Project.create({'name': 'Escalation Milestones'})
+        milestone = self.env['project.task'].create({
+            'name': 'Milestone', 'project_id': milestones.id, 'stage_id': closed.id,
+        })
+        site = self.Project.create({
+            'name': 'Site Closed Milestone', 'stage_site_id': milestone.id,
+            'deadline_date': self.now + timedelta(days=90),
+        })
+        self._set_deadline_in_db(site, self.now - timedelta(days=1))
+
+        self.Watermark._cron_escalate_deadlines(now=self.now)
+        self.assertFalse(site.deadline_escalation)
+        self.assertFalse(self._activities(site))
+
+        milestone.stage_id = open_stage
+        self.assertEqual(site.deadline_escalation, 'overdue')
+        self.assertEqual(len(self._activities(site)), 1)
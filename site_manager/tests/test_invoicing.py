@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+import threading
+from datetime import date, timedelta
+from unittest.mock import patch
+
+from psycopg2 import OperationalError, errorcodes
+
+from odoo.exceptions import UserError
+from odoo.tests.common import TransactionCase
+
+from odoo.addons.site_manager.models.study_case import INVOICING_LOCK_NAMESPACE
+
+
+class _SerializationFailure(OperationalError):
+    pgcode = errorcodes.SERIALIZATION_FAILURE
+
+
+class TestInvoicingBatch(TransactionCase):
+
+    def setUp(self):
+        super(TestInvoicingBatch, self).setUp()
+        # the invoicing flow relies on models of the customer database (legacy invoices, hr jobs with products)
+        for model in ('account.invoice', 'account.invoice.line', 'account.analytic.line', 'hr.employee', 'hr.job'):
+            if model not in self.env:
+                self.skipTest("Model %s is not available" % model)
+        if 'product_inhouse_id' not in self.env['hr.job']._fields:
+            self.skipTest("hr.job has no product_inhouse_id")
+
+        self.Project = self.env['project.project']
+        self.AnalyticLine = self.env['account.analytic.line']
+
+        today = date.today()
+        self.last_sunday = today - timedelta(days=(today.weekday() + 1) % 7)
+        self.env.user.company_id.inv_start_date = self.last_sunday - timedelta(days=30)
+
+        self.product = self.env['product.product'].create({'name': 'Consulting Hour', 'list_price': 50.0})
+        self.job = self.env['hr.job'].create({
+            'name': 'Consultant',
+            'product_inhouse_id': self.product.id,
+            'product_outsource_id': self.product.id,
+        })
+        self.partner = self.env['res.partner'].create({'name': 'Port City Customer'})
+        self.invoice = self.env['account.invoice'].create({'partner_id': self.partner.id})
+
+    def _create_site_with_timesheets(self, users_count):
+        """Site with its own analytic account and one timesheet per new user (one invoice group each)."""
+        account = self.env['account.analytic.account'].create({'name': 'Site %s users' % users_count})
+        site = self.Project.create({'name': 'Site %s users' % users_count, 'analytic_account_id': account.id})
+        for i in range(users_count):
+            user = self.env['res.users'].create({
+                'name': 'Consultant %s/%s' % (users_count, i),
+                'login': 'consultant_%s_%s_%s' % (account.id, users_count, i),
+            })
+            self.env['hr.employee'].create({'name': user.name, 'user_id': user.id, 'job_id': self.job.id})
+            self.AnalyticLine.create({
+                'name': 'Work',
+                'account_id': account.id,
+                'project_id': site.id,
+                'user_id': user.id,
+                'unit_amount': 2.0,
+                'date': self.last_sunday - timedelta(days=1),
+                'invoiceable_analytic_line': True,
+            })
+        return site
+
+    def _create_job(self, sites, chunk_size=1):
+        return self.env['site.invoicing.job'].create({
+            'project_ids': [(6, 0, sites.ids)],
+            'invoice_model': 'account.invoice',
+            'invoice_id': self.invoice.id,
+            'chunk_size': chunk_size,
+        })
+
+    def _create_run(self, sites, workers=1):
+        return self.env['site.invoicing.run'].create({
+            'project_ids': [(6, 0, sites.ids)],
+            'invoice_model': 'account.invoice',
+            'invoice_id': self.invoice.id,
+            'workers': workers,
+        })
+
+    def _create_sections(self, site, tasks):
+        """Sale order of the site account with one section per task (or without task for False)."""
+        Account = self.env['account.analytic.account']
+        if 'sale.order' not in self.env or 'section_ids' not in Account._fields:
+            self.skipTest("Analytic accounts have no sections")
+        if 'task_id' not in self.env[Account._fields['section_ids'].comodel_name]._fields:
+            self.skipTest("Analytic sections have no task_id")
+        account = site.analytic_account_id
+        account.write({'section_ids': [
+            (0, 0, {'name': 'Section %s' % i, 'task_id': task.id if task else False}) for i, task in enumerate(tasks)
+        ]})
+        self.env['sale.order'].create({'partner_id': self.partner.id, 'analytic_account_id': account.id})
+        return account.section_ids
+
+    def _count_queries(self, site):
+        start = self.cr.sql_log_count
+        result = site.create_invoice_line_multi(self.invoice)
+        return self.cr.sql_log_count - start, result[site.id]
+
+    def test_batch_matches_single_site(self):
+        """Una factura de varios sites debe dar el mismo resultado por site que el camino individual."""
+        site_a = self._create_site_with_timesheets(2)
+        site_b = self._create_site_with_timesheets(3)
+
+        results = (site_a | site_b).create_invoice_line_multi(self.invoice)
+        self.assertEqual(results[site_a.id]['status'], 'invoiced')
+        self.assertEqual(len(results[site_a.id]['lines']), 2)
+        self.assertEqual(len(results[site_b.id]['lines']), 3)
+        self.assertAlmostEqual(results[site_b.id]['hours'], 6.0)
+        for line in results[site_b.id]['lines']:
+            self.assertEqual(line.account_analytic_id, site_b.analytic_account_id)
+
+        # every timesheet is now linked, nothing left for the single site path
+        lines = self.AnalyticLine.search([('account_id', 'in', (site_a | site_b).analytic_account_id.ids)])
+        self.assertEqual(lines.mapped('project_invoice_line_id.id'), [self.invoice.id])
+        self.assertIs(site_a.create_invoice_line(self.invoice), True)
+
+    def test_sections_without_task_invoice_nothing(self):
+        """Si el pedido tiene secciones pero ninguna con tarea, no se factura nada, como en el camino original."""
+        site = self._create_site_with_timesheets(2)
+        self._create_sections(site, [False])
+
+        result = site.create_invoice_line_multi(self.invoice)[site.id]
+        self.assertEqual(result['status'], 'nothing')
+        lines = self.AnalyticLine.search([('account_id', '=', site.analytic_account_id.id)])
+        self.assertFalse(lines.filtered('project_invoice_line_id'))
+
+    def _create_task_tree(self, site, depth):
+        """Chain of ``depth`` tasks, each one the parent of the next."""
+        if 'parent_task_id' not in self.env['project.task']._fields:
+            self.skipTest("Tasks have no parent_task_id")
+        tasks = self.env['project.task']
+        for i in range(depth):
+            tasks |= self.env['project.task'].create({
+                'name': 'Task %s' % i, 'project_id': site.id,
+                'parent_task_id': tasks[-1:].id or False,
+            })
+        return tasks
+
+    def test_overlapping_sections_invoice_once(self):
+        """Una tarea bajo dos secciones sólo se factura en la primera, y las consultas no crecen con las secciones."""
+        site = self._create_site_with_timesheets(1)
+        tasks = self._create_task_tree(site, 3)
+        # the second section is a subtree of the first one
+        sections = self._create_sections(site, [tasks[0], tasks[1]])
+        self.AnalyticLine.search([('account_id', '=', site.analytic_account_id.id)]).task_id = tasks[2]
+
+        sale_orders = self.Project._get_invoicing_sale_orders(site.analytic_account_id.ids)
+        section_tasks = self.Project._get_invoicing_sections(sale_orders)[site.analytic_account_id.id]
+        self.assertEqual([section for section, dummy in section_tasks], [sections[0]])
+        self.assertEqual(set(section_tasks[0][1]), set(tasks.ids))
+
+        result = site.create_invoice_line_multi(self.invoice)[site.id]
+        self.assertEqual(result['status'], 'invoiced')
+        self.assertEqual(result['lines'].mapped('layout_category_id'), sections[0])
+        self.assertAlmostEqual(result['hours'], 2.0)
+
+        def count_queries(sections_count):
+            other = self._create_site_with_timesheets(1)
+            roots = self._create_task_tree(other, sections_count)
+            self._create_sections(other, list(roots))
+            sale_orders = self.Project._get_invoicing_sale_orders(other.analytic_account_id.ids)
+            self.env.invalidate_all()
+            start = self.cr.sql_log_count
+            self.Project._get_invoicing_sections(sale_orders)
+            return self.cr.sql_log_count - start
+
+        self.assertEqual(count_queries(1), count_queries(5))
+
+    def test_product_and_price_hook_is_called(self):
+        """Las extensiones de _determine_product_and_price siguen aplicándose en la facturación por lotes."""
+        site = self._create_site_with_timesheets(2)
+        Project = type(self.Project)
+        determine = Project._determine_product_and_price
+
+        def double_price(self, sale_order, employee, fallback_employee_data):
+            product, price_unit, uom_id = determine(self, sale_order, employee, fallback_employee_data)
+            return product, price_unit * 2, uom_id
+
+        with patch.object(Project, '_determine_product_and_price', autospec=True, side_effect=double_price) as hook:
+            result = site.create_invoice_line_multi(self.invoice)[site.id]
+        self.assertEqual(hook.call_count, 2)
+        self.assertEqual(result['lines'].mapped('price_unit'), [100.0, 100.0])
+
+    def test_invoice_line_hook_is_called(self):
+        """Las extensiones de _create_invoice_line_record se llaman una vez por línea de factura."""
+        site = self._create_site_with_timesheets(3)
+        Project = type(self.Project)
+        create_line = Project._create_invoice_line_record
+
+        def named_line(self, *args, **kwargs):
+            line = create_line(self, *args, **kwargs)
+            line.name = 'hook'
+            return line
+
+        with patch.object(Project, '_create_invoice_line_record', autospec=True, side_effect=named_line) as hook:
+            result = site.create_invoice_line_multi(self.invoice)[site.id]
+        self.assertEqual(hook.call_count, 3)
+        self.assertEqual(result['lines'].mapped('name'), ['hook'] * 3)
+        self.assertFalse(self.AnalyticLine.search([
+            ('account_id', '=', site.analytic_account_id.id), ('project_invoice_line_id', '=', False),
+        ]))
+
+    def _skip_first_user(self):
+        """Extensión de _aggregate_timesheets que no factura al primer usuario."""
+        Project = type(self.Project)
+        aggregate = Project._aggregate_timesheets
+
+        def skip_first_user(self, *args, **kwargs):
+            return aggregate(self, *args, **kwargs)[1:]
+
+        return patch.object(Project, '_aggregate_timesheets', autospec=True, side_effect=skip_first_user)
+
+    def test_aggregate_timesheets_hook_is_called(self):
+        """Las extensiones de _aggregate_timesheets deciden qué líneas se facturan."""
+        site = self._create_site_with_timesheets(3)
+        lines = self.AnalyticLine.search([('account_id', '=', site.analytic_account_id.id)], order='user_id')
+        with self._skip_first_user() as hook:
+            result = site.create_invoice_line_multi(self.invoice)[site.id]
+        self.assertEqual(hook.call_count, 1)
+        self.assertEqual(len(result['lines']), 2)
+        self.assertAlmostEqual(result['hours'], 4.0)
+        self.assertFalse(lines[0].project_invoice_line_id)
+        self.assertEqual(lines[1:].mapped('project_invoice_line_id.id'), [self.invoice.id])
+        self.assertEqual(self.env['site.timesheet.summary']._check_consistency(), [])
+
+    def test_job_uses_aggregate_timesheets_hook(self):
+        """El job también factura las líneas elegidas por una extensión de _aggregate_timesheets."""
+        site = self._create_site_with_timesheets(3)
+        lines = self.AnalyticLine.search([('account_id', '=', site.analytic_account_id.id)], order='user_id')
+        job = self._create_job(site)
+        with self._skip_first_user():
+            self.assertTrue(job._run())
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.lines_created, 2)
+        self.assertFalse(lines[0].project_invoice_line_id)
+        self.assertEqual(lines[1:].mapped('project_invoice_line_id.id'), [self.invoice.id])
+
+    def test_query_count_flat_with_groups(self):
+        """El número de consultas no debe crecer con el número de grupos a facturar."""
+        # warm up caches (rules, ormcache, prepared statements of create)
+        self._count_queries(self._create_site_with_timesheets(1))
+
+        small_count, small_result = self._count_queries(self._create_site_with_timesheets(2))
+        large_count, large_result = self._count_queries(self._create_site_with_timesheets(8))
+        self.assertEqual(len(small_result['lines']), 2)
+        self.assertEqual(len(large_result['lines']), 8)
+        self.assertEqual(small_count, large_count)
+
+    def test_timesheet_summary_stays_consistent(self):
+        """La tabla resumen debe seguir igual a la agregación en vivo tras crear, editar, facturar y borrar."""
+        Summary = self.env['site.timesheet.summary']
+        site = self._create_site_with_timesheets(3)
+        self.assertEqual(Summary._check_consistency(), [])
+
+        lines = self.AnalyticLine.search([('account_id', '=', site.analytic_account_id.id)])
+        lines[0].unit_amount = 5.0
+        lines[1].date = self.last_sunday - timedelta(days=10)
+        self.assertEqual(Summary._check_consistency(), [])
+
+        preview = site.get_uninvoiced_hours_preview()[site.id]
+        self.assertAlmostEqual(preview['hours'], 9.0)
+
+        site.create_invoice_line(self.invoice)
+        self.assertEqual(Summary._check_consistency(), [])
+        self.assertFalse(Summary.search([('account_id', '=', site.analytic_account_id.id)]))
+        self.assertAlmostEqual(site.get_uninvoiced_hours_preview()[site.id]['hours'], 0.0)
+
+        lines[2].unlink()
+        self.assertEqual(Summary._check_consistency(), [])
+
+    def test_summary_drift_is_refreshed(self):
+        """Si la tabla resumen quedó desfasada, se facturan las horas reales y se corrige el resumen."""
+        Summary = self.env['site.timesheet.summary']
+        site = self._create_site_with_timesheets(2)
+        account = site.analytic_account_id
+        # simulate a drift: one key lost, another one with wrong hours
+        Summary.flush_model()
+        self.env.cr.execute("""
+            DELETE FROM site_timesheet_summary
+            WHERE id = (SELECT MIN(id) FROM site_timesheet_summary WHERE account_id = %s)
+        """, (account.id,))
+        self.env.cr.execute("UPDATE site_timesheet_summary SET hours = hours + 1 WHERE account_id = %s", (account.id,))
+        Summary.invalidate_model()
+        self.assertTrue(Summary._check_consistency())
+
+        result = site.create_invoice_line_multi(self.invoice)[site.id]
+        self.assertEqual(result['status'], 'invoiced')
+        self.assertEqual(len(result['lines']), 2)
+        self.assertAlmostEqual(result['hours'], 4.0)
+        lines = self.AnalyticLine.search([('account_id', '=', account.id)])
+        self.assertEqual(lines.mapped('project_invoice_line_id.id'), [self.invoice.id])
+        self.assertEqual(Summary._check_consistency(), [])
+
+    def test_job_resumes_on_uninvoiced_timesheets(self):
+        """Un job interrumpido debe retomar sólo lo que quedó sin facturar, sin duplicar horas."""
+        site = self._create_site_with_timesheets(3)
+        account = site.analytic_account_id
+        job = self._create_job(site)
+        start_date, end_date = self.Project._compute_invoice_date_range()
+        # state left by a run interrupted after its first committed chunk
+        first_user = min(self.AnalyticLine.search([('account_id', '=', account.id)]).user_id.ids)
+        self.Project._mark_timesheets_invoiced(
+            self.invoice, [account.id], start_date, end_date, group_keys=[(False, first_user)])
+        job.write({
+            'state': 'running',
+            'start_date': start_date,
+            'end_date': end_date,
+            'current_project_id': site.id,
+            'groups_done': 1,
+            'hours_done': 2.0,
+        })
+        # the cursor of the interrupted run is still open on this connection
+        self.env.cr.execute("DECLARE site_invoicing_job_%s NO SCROLL CURSOR WITH HOLD FOR SELECT 1" % job.id)
+
+        self.assertIs(job._run(), True)
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.done_project_ids, site)
+        self.assertEqual(job.groups_done, 3)
+        self.assertEqual(job.lines_created, 2)
+        self.assertAlmostEqual(job.hours_done, 6.0)
+        lines = self.AnalyticLine.search([('account_id', '=', account.id)])
+        self.assertEqual(lines.mapped('project_invoice_line_id.id'), [self.invoice.id])
+        self.assertEqual(self.env['site.timesheet.summary']._check_consistency(), [])
+
+    def test_job_skips_locked_account(self):
+        """Si otra corrida tiene bloqueada la cuenta analítica, el job la salta y queda pendiente."""
+        site = self._create_site_with_timesheets(2)
+        account = site.analytic_account_id
+        job = self._create_job(site)
+        with self.registry.cursor() as other_cr:
+            other_cr.execute("SELECT pg_advisory_lock(%s, %s)", (INVOICING_LOCK_NAMESPACE, account.id))
+            try:
+                self.assertIs(job._run(), True)
+            finally:
+                other_cr.execute("SELECT pg_advisory_unlock(%s, %s)", (INVOICING_LOCK_NAMESPACE, account.id))
+        self.assertEqual(job.state, 'running')
+        self.assertFalse(job.done_project_ids)
+        self.assertFalse(self.AnalyticLine.search([
+            ('account_id', '=', account.id), ('project_invoice_line_id', '!=', False)]))
+
+        # the next run, once the lock is released, invoices the account
+        job._run()
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.lines_created, 2)
+        self.assertAlmostEqual(job.hours_done, 4.0)
+
+    def test_run_partitions_keep_accounts_together(self):
+        """Las particiones deben repartir la carga sin separar los sites de una misma cuenta analítica."""
+        sites = self.Project
+        for name, count in (('A', 3), ('B', 2), ('C', 1)):
+            account = self.env['account.analytic.account'].create({'name': 'Shared %s' % name})
+            for i in range(count):
+                sites |= self.Project.create({'name': 'Site %s%s' % (name, i), 'analytic_account_id': account.id})
+        run = self._create_run(sites, workers=2)
+
+        partitions = run._get_partitions(2)
+        self.assertEqual(sorted(len(partition) for partition in partitions), [3, 3])
+        self.assertEqual(sorted(project_id for partition in partitions for project_id in partition), sorted(sites.ids))
+        for partition in partitions:
+            accounts = self.Project.browse(partition).analytic_account_id
+            for other in partitions:
+                if other is not partition:
+                    self.assertFalse(accounts & self.Project.browse(other).analytic_account_id)
+        # never more partitions than sites
+        self.assertEqual(len(run._get_partitions(10)), 3)
+
+    def test_run_isolates_failing_site(self):
+        """Un site que falla en la corrida serial se deshace sin afectar a los demás."""
+        site_ok = self._create_site_with_timesheets(2)
+        site_ko = self._create_site_with_timesheets(1)
+        run = self._create_run(site_ok | site_ko)
+        Run = self.env['site.invoicing.run']
+        invoice_site = Run._invoice_site
+
+        def failing_invoice_site(env, project_id, invoice_ref):
+            outcome = invoice_site(env, project_id, invoice_ref)
+            if project_id == site_ko.id:
+                raise ValueError("Invoice line constraint failed")
+            return outcome
+
+        with patch.object(type(Run), '_invoice_site', side_effect=failing_invoice_site):
+            run._run()
+        results = {result.project_id: result for result in run.result_ids}
+        self.assertEqual(results[site_ok].status, 'invoiced')
+        self.assertEqual(results[site_ok].line_count, 2)
+        self.assertAlmostEqual(results[site_ok].hours, 4.0)
+        self.assertEqual(results[site_ko].status, 'error')
+        self.assertIn("constraint failed", results[site_ko].message)
+        self.assertEqual((run.invoiced_count, run.error_count), (1, 1))
+        # the savepoint undid the marking of the failing site only
+        self.assertFalse(self.AnalyticLine.search([
+            ('account_id', '=', site_ko.analytic_account_id.id), ('project_invoice_line_id', '!=', False)]))
+        self.assertFalse(self.AnalyticLine.search([
+            ('account_id', '=', site_ok.analytic_account_id.id), ('project_invoice_line_id', '=', False)]))
+
+    def test_threaded_run_refuses_uncommitted_invoice(self):
+        """Con varios workers, una factura aún no confirmada en la base de datos se rechaza antes de lanzar los hilos."""
+        site = self._create_site_with_timesheets(1)
+        run = self._create_run(site, workers=2)
+        with patch.object(threading.current_thread(), 'testing', False), \
+                patch('odoo.addons.site_manager.models.invoicing_run.ThreadPoolExecutor') as executor:
+            with self.assertRaises(UserError):
+                run._run()
+        executor.assert_not_called()
+        self.assertEqual(run.state, 'draft')
+
+    def test_threaded_run_collects_worker_outcomes(self):
+        """Con varios workers, cada partición corre en su hilo y su propio cursor, y se recogen todos los resultados."""
+        sites = self._create_site_with_timesheets(1) | self._create_site_with_timesheets(1)
+        run = self._create_run(sites, workers=2)
+        Run = self.env['site.invoicing.run']
+        threads = {}
+
+        def invoice_site(env, project_id, invoice_ref):
+            threads[project_id] = (threading.current_thread().name, env.cr is not self.env.cr)
+            return {'status': 'nothing', 'hours': 0.0, 'line_count': 0, 'message': '', 'attempts': 1}
+
+        with patch.object(threading.current_thread(), 'testing', False), \
+                patch.object(type(Run), '_check_visible_to_workers'), \
+                patch.object(type(Run), '_invoice_site', side_effect=invoice_site):
+            run._run()
+        self.assertEqual(run.state, 'done')
+        self.assertEqual(run.result_ids.project_id, sites)
+        self.assertEqual(set(threads), set(sites.ids))
+        for thread_name, own_cursor in threads.values():
+            self.assertTrue(thread_name.startswith('site_invoicing'))
+            self.assertTrue(own_cursor)
+
+    def test_run_retries_concurrency_errors(self):
+        """Un error de serialización se reintenta y el resultado cuenta los intentos."""
+        site = self._create_site_with_timesheets(2)
+        run = self._create_run(site)
+        Run = self.env['site.invoicing.run']
+        invoice_site = Run._invoice_site
+        calls = []
+
+        def flaky_invoice_site(env, project_id, invoice_ref):
+            calls.append(project_id)
+            if len(calls) == 1:
+                raise _SerializationFailure("could not serialize access")
+            return invoice_site(env, project_id, invoice_ref)
+
+        with patch.object(type(Run), '_invoice_site', side_effect=flaky_invoice_site), \
+                patch('odoo.addons.site_manager.models.invoicing_run.time.sleep'):
+            run._run()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(run.result_ids.status, 'invoiced')
+        self.assertEqual(run.result_ids.attempts, 2)
+        self.assertEqual(run.result_ids.line_count, 2)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from odoo import fields
+from odoo.tests.common import TransactionCase
+
+
+class TestPortfolioSummary(TransactionCase):
+
+    def setUp(self):
+        super(TestPortfolioSummary, self).setUp()
+        self.Summary = self.env['site.portfolio.summary']
+        self.Project = self.env['project.project']
+        self.milestone = self.env['project.task'].create({
+            'name': 'Milestone Portfolio',
+            'project_id': self.Project.create({'name': 'Portfolio Milestones'}).id,
+        })
+
+    def _row(self, project_size, fold=True):
+        if fold:
+            self.Summary._fold_deltas()
+        return self.Summary.search([
+            ('company_id', '=', self.env.company.id),
+            ('stage_site_id', '=', self.milestone.id),
+            ('project_size', '=', project_size),
+        ])
+
+    def test_summary_follows_site_writes(self):
+        """El resumen por (company, milestone, size) se actualiza con cada alta, cambio y baja de site."""
+        # overdue counts are as of the watermark, moved to now
+        self.Summary._cron_refresh_overdue()
+        sites = self.Project.create([{
+            'name': 'Site Portfolio %s' % i,
+            'company_id': self.env.company.id,
+            'stage_site_id': self.milestone.id,
+            'project_size': 'small',
+            'budget': 100.0,
+            'deadline_date': fields.Datetime.now() - timedelta(days=i),
+        } for i in range(1, 4)])
+        # site writes only log their changes, the cron folds them into the shared rows
+        self.assertFalse(self._row('small', fold=False))
+        self.assertTrue(self.env['site.portfolio.delta'].search_count([]))
+        row = self._row('small')
+        self.assertEqual((row.site_count, row.budget, row.overdue_count), (3, 300.0, 3))
+        self.assertFalse(self.env['site.portfolio.delta'].search_count([]))
+        self.assertEqual(row.overdue_as_of, self.env['site.portfolio.watermark'].search([]).overdue_until)
+
+        sites[0].write({'project_size': 'large', 'budget': 50.0})
+        self.assertEqual(self._row('small', fold=False).site_count, 3)
+        self.assertEqual((self._row('small').site_count, self._row('small').budget), (2, 200.0))
+        self.assertEqual((self._row('large').site_count, self._row('large').budget), (1, 50.0))
+
+        sites[1].deadline_date = fields.Datetime.now() + timedelta(days=30)
+        self.assertEqual((self._row('small').site_count, self._row('small').overdue_count), (2, 1))
+
+        sites[1].unlink()
+        sites[2].active = False
+        self.assertFalse(self._row('small'))
+        self.assertFalse(self.Summary._check_consistency())
+
+    def test_overdue_refresh_only_reads_crossed_deadlines(self):
+        """El cron recalcula los overdue de los sites cuyo deadline ha pasado desde la última ejecución."""
+        site = self.Project.create({
+            'name': 'Site Soon Overdue', 'company_id': self.env.company.id,
+            'stage_site_id': self.milestone.id, 'project_size': 'medium',
+            'deadline_date': fields.Datetime.now() + timedelta(hours=1),
+        })
+        self.assertEqual(self._row('medium').overdue_count, 0)
+        self.Summary._cron_refresh_overdue()
+
+        # simulate the deadline passing, as the clock would
+        self.env.cr.execute("UPDATE project_project SET deadline_date = %s WHERE id = %s",
+                            (fields.Datetime.now() - timedelta(seconds=1), site.id))
+        self.env['site.portfolio.watermark'].search([]).overdue_until = fields.Datetime.now() - timedelta(minutes=15)
+        self.Summary._cron_refresh_overdue()
+        self.assertEqual(self._row('medium').overdue_count, 1)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import json
+from datetime import date, timedelta
+
+from odoo import tools
+from odoo.tests.common import TransactionCase, tagged
+
+from .common import SiteDataGenerator
+
+
+@tagged('post_install', '-at_install')
+class TestQueryPlans(TransactionCase):
+    """Seed volume data, EXPLAIN the hot queries of the module and fail on sequential scans."""
+
+    VOLUME = 20000
+
+    def setUp(self):
+        super(TestQueryPlans, self).setUp()
+        self.generator = SiteDataGenerator(self.env)
+
+    def _scanned_tables(self, query, params):
+        """Return the tables read with a sequential scan in the plan of ``query``."""
+        self.cr.execute("EXPLAIN (FORMAT JSON) " + query, params)
+        plan = self.cr.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        scanned = set()
+        nodes = [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if node.get('Node Type') == 'Seq Scan':
+                scanned.add(node.get('Relation Name'))
+            nodes.extend(node.get('Plans', []))
+        return scanned
+
+    def assertNoSeqScan(self, tables, query, params=()):
+        scanned = self._scanned_tables(query, params) & set(tables)
+        self.assertFalse(scanned, "Sequential scan on %s for query:\n%s" % (', '.join(sorted(scanned)), query))
+
+    def test_requirement_rule_lookup(self):
+        """La búsqueda de la regla por (requirement, stage, company) debe usar un índice."""
+        Req = self.env['dynamic.requirement.field']
+        stage = self.env['project.task'].search([], limit=1)
+        if not stage:
+            self.skipTest("No project.task to use as milestone")
+        req = Req.create({'name': 'Req Volume'})
+        line = self.env['dynamic.requirement.field.line'].create({'requirement_id': req.id, 'stage_id': stage.id})
+        others = Req.create([{'name': 'Req Volume %s' % i} for i in range(50)])
+        self.generator.clone_rows('dynamic_requirement_field_line', line.id, self.VOLUME, {
+            'requirement_id': self.generator.sql_pick(others.ids),
+        })
+        self.assertNoSeqScan(['dynamic_requirement_field_line'], """
+            SELECT id FROM dynamic_requirement_field_line
+            WHERE requirement_id = %s AND stage_id = %s AND (company_id = %s OR company_id IS NULL)
+            ORDER BY sequence, id LIMIT 1
+        """, (req.id, stage.id, self.env.company.id))
+
+    def test_site_filters(self):
+        """Los filtros y agrupaciones de los sites por deadline, tamaño, milestone y requirement deben usar índices."""
+        site = self.env['project.project'].create({'name': 'Site Volume'})
+        self.generator.clone_rows('project_project', site.id, self.VOLUME, {
+            'deadline_date': "CASE WHEN g % 100 = 0 THEN now() at time zone 'UTC' + g * interval '1 hour' END",
+            'project_size': "CASE WHEN g % 200 = 0 THEN 'large' END",
+        })
+        today = date.today()
+        self.assertNoSeqScan(['project_project'], """
+            SELECT id FROM project_project WHERE deadline_date >= %s AND deadline_date < %s
+        """, (today, today + timedelta(days=2)))
+        self.assertNoSeqScan(['project_project'], """
+            SELECT id FROM project_project WHERE project_size = 'large'
+        """)
+        self.assertNoSeqScan(['project_project'], """
+            SELECT id FROM project_project WHERE stage_site_id = %s
+        """, (0,))
+        self.assertNoSeqScan(['project_project'], """
+            SELECT id FROM project_project WHERE requirement_id = %s
+        """, (0,))
+        sql, params = self.env['project.project']._get_deadline_crossing_query(
+            'large', today, 0, today + timedelta(days=30), 1000)
+        self.assertNoSeqScan(['project_project'], sql, params)
+
+    def test_timesheet_aggregation(self):
+        """La agregación de horas no facturadas debe usar el índice parcial de account_analytic_line."""
+        if not tools.column_exists(self.cr, 'account_analytic_line', 'invoiceable_analytic_line'):
+            self.skipTest("account_analytic_line has no invoiceable_analytic_line")
+        accounts = self.env['account.analytic.account'].create([{'name': 'Volume %s' % i} for i in range(50)])
+        site = self.env['project.project'].create({'name': 'Site Timesheets', 'analytic_account_id': accounts[0].id})
+        line = self.env['account.analytic.line'].create({
+            'name': 'Work', 'account_id': accounts[0].id, 'project_id': site.id,
+            'unit_amount': 1.0, 'date': date.today(), 'invoiceable_analytic_line': True,
+        })
+        # most of the volume is not invoiceable, as in production
+        self.generator.clone_rows('account_analytic_line', line.id, self.VOLUME, {
+            'account_id': self.generator.sql_pick(accounts.ids),
+            'date': "current_date - (g % 700)",
+            'invoiceable_analytic_line': "g % 20 = 0",
+        })
+        sql, params, dummy = self.env['project.project']._get_timesheet_aggregation_query(
+            [accounts[1].id], date.today() - timedelta(days=60), date.today())
+        self.assertNoSeqScan(['account_analytic_line'], sql, params)
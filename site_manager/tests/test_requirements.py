@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+from unittest.mock import patch
+
 from odoo.tests.common import TransactionCase
 from odoo.exceptions import ValidationError
 
@@ -6,15 +8,17 @@ class TestDynamicRequirements(TransactionCase):
 
     def setUp(self):
         super(TestDynamicRequirements, self).setUp()
-        self.Stage = self.env['site.stage']
+        self.Task = self.env['project.task']
         self.Req = self.env['dynamic.requirement.field']
         self.ReqLine = self.env['dynamic.requirement.field.line']
         self.Project = self.env['project.project']
         self.IrField = self.env['ir.model.fields']
         self.Partner = self.env['res.partner']
 
-        self.stage_from = self.Stage.create({'name': 'Stage A'})
-        self.stage_to = self.Stage.create({'name': 'Stage B'})
+        # milestones are project.task records, as in the requirement lines and stage_site_id
+        milestones_project = self.Project.create({'name': 'Milestones'})
+        self.stage_from = self.Task.create({'name': 'Stage A', 'project_id': milestones_project.id})
+        self.stage_to = self.Task.create({'name': 'Stage B', 'project_id': milestones_project.id})
 
         self.partner_field = self.IrField.search([('model','=','project.project'), ('name','=','partner_id')], limit=1)
         if not self.partner_field:
@@ -37,7 +41,7 @@ class TestDynamicRequirements(TransactionCase):
         proj.requirement_id = req
 
         with self.assertRaises(ValidationError) as cm:
-            proj.write({'stage_id': self.stage_to.id})
+            proj.write({'stage_site_id': self.stage_to.id})
         msg = str(cm.exception) or ''
         self.assertTrue('customer' in msg.lower() or 'mandatory' in msg.lower() or 'oblig' in msg.lower())
 
@@ -56,8 +60,16 @@ class TestDynamicRequirements(TransactionCase):
         partner = self.Partner.create({'name': 'ACME Test'})
         proj.partner_id = partner
 
-        proj.write({'stage_id': self.stage_to.id})
-        self.assertEqual(proj.stage_id.id, self.stage_to.id)
+        proj.write({'stage_site_id': self.stage_to.id})
+        self.assertEqual(proj.stage_site_id.id, self.stage_to.id)
+
+    def test_project_stage_is_not_checked_as_milestone(self):
+        """Mover el site en el kanban de etapas (stage_id, project.project.stage) no valida requisitos de milestone."""
+        proj = self.Project.create({'name': 'Site Kanban', 'company_id': self.env.company.id})
+        stage = self.env['project.project.stage'].create({'name': 'Kanban Stage'})
+        with patch.object(type(self.Project), '_collect_stage_violations', side_effect=AssertionError("milestone checked")):
+            proj.write({'stage_id': stage.id})
+        self.assertEqual(proj.stage_id, stage)
 
     def test_custom_warning_message_is_shown(self):
         """Si hay custom_warning_msg configurada, la ValidationError debe contener exactamente ese texto (o al menos incluirlo)."""
@@ -74,5 +86,181 @@ class TestDynamicRequirements(TransactionCase):
         proj.requirement_id = req
 
         with self.assertRaises(ValidationError) as cm:
-            proj.write({'stage_id': self.stage_to.id})
+            proj.write({'stage_site_id': self.stage_to.id})
         self.assertIn(custom_msg, str(cm.exception))
+
+    def test_rule_cache_invalidated_on_line_change(self):
+        """La regla compilada se cachea, pero cambiar mandatory_fields debe invalidarla."""
+        req = self.Req.create({'name': 'Req Cache', 'type': 'site'})
+        line = self.ReqLine.create({
+            'requirement_id': req.id,
+            'stage_id': self.stage_to.id,
+        })
+
+        proj = self.Project.create({'name': 'Site Cache', 'company_id': self.env.company.id})
+        proj.requirement_id = req
+
+        ok, dummy = self.Project._check_record_mandatory_for_stage(proj, self.stage_to)
+        self.assertTrue(ok)
+
+        line.mandatory_fields = [(6, 0, [self.partner_field.id])]
+        ok, msg = self.Project._check_record_mandatory_for_stage(proj, self.stage_to)
+        self.assertFalse(ok)
+        self.assertIn(self.partner_field.field_description, msg)
+
+    def test_multi_write_lists_every_blocking_site(self):
+        """Un write sobre varios sites debe fallar una sola vez, listando todos los sites bloqueados."""
+        req = self.Req.create({'name': 'Req Multi', 'type': 'site'})
+        self.ReqLine.create({
+            'requirement_id': req.id,
+            'stage_id': self.stage_to.id,
+            'mandatory_fields': [(6, 0, [self.partner_field.id])],
+        })
+        partner = self.Partner.create({'name': 'ACME Multi'})
+        blocked = self.Project.create([
+            {'name': 'Site Blocked %s' % i, 'company_id': self.env.company.id, 'requirement_id': req.id}
+            for i in range(3)
+        ])
+        ready = self.Project.create({
+            'name': 'Site Ready', 'company_id': self.env.company.id,
+            'requirement_id': req.id, 'partner_id': partner.id,
+        })
+
+        with self.assertRaises(ValidationError) as cm:
+            (blocked | ready).write({'stage_site_id': self.stage_to.id})
+        msg = str(cm.exception)
+        for proj in blocked:
+            self.assertIn(proj.display_name, msg)
+        self.assertNotIn(ready.display_name, msg)
+
+    def test_instrumentation_records_stage_checks(self):
+        """Con la instrumentación activa, cada validación queda contada (llamadas, consultas, filas) y muestreada en el log."""
+        Sample = self.env['site.metrics.sample']
+        self.env['ir.config_parameter'].sudo().set_param('site_manager.instrumentation', 'True')
+        self.env['ir.config_parameter'].sudo().set_param('site_manager.instrumentation_sample_rate', '1')
+        calls_before = Sample.get_counters().get('requirement.collect_violations', {}).get('calls', 0)
+
+        proj = self.Project.create({'name': 'Site Metrics', 'company_id': self.env.company.id})
+        with self.assertLogs('odoo.addons.site_manager.models.metrics', 'INFO') as logs:
+            proj.write({'stage_site_id': self.stage_to.id})
+
+        counter = Sample.get_counters()['requirement.collect_violations']
+        self.assertEqual(counter['calls'], calls_before + 1)
+        self.assertTrue(any(
+            '"operation": "requirement.collect_violations"' in line
+            and '"ref": "stage:%s sites:%s"' % (self.stage_to.id, proj.id) in line
+            for line in logs.output
+        ))
+
+    def test_stage_readiness_is_maintained(self):
+        """La readiness por milestone se guarda y se actualiza al rellenar el campo o cambiar la línea."""
+        req = self.Req.create({'name': 'Req Readiness', 'type': 'site'})
+        line = self.ReqLine.create({
+            'requirement_id': req.id,
+            'stage_id': self.stage_to.id,
+            'mandatory_fields': [(6, 0, [self.partner_field.id])],
+        })
+        proj = self.Project.create({'name': 'Site Readiness', 'company_id': self.env.company.id, 'requirement_id': req.id})
+
+        readiness = proj.stage_readiness_ids
+        self.assertEqual(len(readiness), 1)
+        self.assertFalse(readiness.ready)
+        self.assertIn(self.partner_field.field_description, readiness.missing_fields)
+        self.assertEqual(proj.stage_blocked_count, 1)
+
+        proj.partner_id = self.Partner.create({'name': 'ACME Readiness'})
+        self.assertTrue(readiness.ready)
+        self.assertEqual(proj.stage_blocked_count, 0)
+
+        # moving the line refreshes its old and new milestones only
+        line.stage_id = self.stage_from
+        self.assertEqual(proj.stage_readiness_ids.stage_id, self.stage_from)
+        self.assertTrue(proj.stage_readiness_ids.ready)
+
+        line.unlink()
+        self.assertFalse(proj.stage_readiness_ids)
+
+    def _stored_field(self, ftype):
+        """A plain stored field of project.project of the given type, written in SQL by the tests."""
+        for fname, field in self.Project._fields.items():
+            if (field.type == ftype and field.store and field.column_type and not field.compute
+                    and not field.related and not getattr(field, 'translate', False)
+                    and not field.company_dependent and fname not in ('active', 'id')):
+                return fname
+        self.skipTest("project.project has no plain %s field" % ftype)
+
+    def _assert_sql_matches_orm(self, sites, fname, values, pushed_down=True):
+        """Write ``values`` behind the ORM, then compare the SQL check with _is_empty_mandatory_value."""
+        sites.flush_recordset()
+        for site, value in zip(sites, values):
+            self.env.cr.execute('UPDATE project_project SET "%s" = %%s WHERE id = %%s' % fname, (value, site.id))
+        self.env.invalidate_all()
+        sql_ok, dummy = self.Project._get_mandatory_sql_condition(fname)
+        self.assertEqual(sql_ok, pushed_down)
+        missing = sites._get_missing_mandatory_fields(((fname, fname),))
+        self.env.invalidate_all()
+        expected = {site.id for site in sites if self.Project._is_empty_mandatory_value(site[fname])}
+        self.assertEqual(set(missing), expected, fname)
+        return expected
+
+    def test_mandatory_sql_matches_orm(self):
+        """La comprobación SQL de campos obligatorios da el mismo resultado que la lectura ORM, campo a campo."""
+        sites = self.Project.create([{'name': 'Site Mandatory %s' % i} for i in range(3)])
+
+        char_field = self._stored_field('char')
+        self.assertEqual(self._assert_sql_matches_orm(sites, char_field, ['', None, 'x']), set(sites[:2].ids))
+
+        bool_field = self._stored_field('boolean')
+        self.assertEqual(self._assert_sql_matches_orm(sites, bool_field, [False, None, True]), set(sites[:2].ids))
+
+        partner = self.Partner.create({'name': 'ACME Mandatory'})
+        self.assertEqual(self._assert_sql_matches_orm(sites, 'partner_id', [None, partner.id, None]),
+                         {sites[0].id, sites[2].id})
+
+        # many2many: NOT EXISTS on the relation table, unless record rules filter the comodel
+        tag_field = self.Project._fields['tag_ids']
+        sites[1].tag_ids = self.env[tag_field.comodel_name].create({'name': 'Mandatory Tag'})
+        pushed_down = not self.env['ir.rule']._compute_domain(tag_field.comodel_name, 'read')
+        missing = self._assert_sql_matches_orm(sites, 'tag_ids', [], pushed_down=pushed_down)
+        self.assertEqual(missing, {sites[0].id, sites[2].id})
+
+        # non-stored computed fields fall back to the ORM
+        computed = next(fname for fname, field in self.Project._fields.items()
+                        if field.compute and not field.store and field.type == 'integer')
+        self.assertEqual(self.Project._get_mandatory_sql_condition(computed), (False, None))
+        missing = sites._get_missing_mandatory_fields(((computed, computed),))
+        self.assertEqual(set(missing), {site.id for site in sites if self.Project._is_empty_mandatory_value(site[computed])})
+
+    def test_validate_stage_transitions_dry_run(self):
+        """La validación en seco devuelve todas las violaciones sin escribir y con consultas acotadas."""
+        req = self.Req.create({'name': 'Req Dry Run', 'type': 'site'})
+        self.ReqLine.create({
+            'requirement_id': req.id,
+            'stage_id': self.stage_to.id,
+            'mandatory_fields': [(6, 0, [self.partner_field.id])],
+        })
+        partner = self.Partner.create({'name': 'ACME Dry Run'})
+        sites = self.Project.create([
+            {'name': 'Site Dry Run %s' % i, 'company_id': self.env.company.id, 'requirement_id': req.id,
+             'partner_id': partner.id if i % 2 else False}
+            for i in range(40)
+        ])
+
+        def validate(records):
+            self.env.invalidate_all()
+            start = self.cr.sql_log_count
+            result = self.Project.validate_stage_transitions([[site.id, self.stage_to.id] for site in records])
+            return self.cr.sql_log_count - start, result
+
+        validate(sites[:2])  # warm the rule cache
+        small_count, dummy = validate(sites[:4])
+        large_count, result = validate(sites)
+        self.assertEqual(large_count, small_count)
+
+        blocked = [r['site_id'] for r in result if not r['valid']]
+        self.assertEqual(blocked, [site.id for site in sites if not site.partner_id])
+        self.assertTrue(all(site.stage_site_id != self.stage_to for site in sites))
+
+        unknown = self.Project.validate_stage_transitions([{'site_id': sites[0].id, 'stage_id': 0}, [0, self.stage_to.id]])
+        self.assertTrue(unknown[0]['valid'])
+        self.assertFalse(unknown[1]['valid'])
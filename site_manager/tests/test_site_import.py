@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import base64
+from unittest.mock import patch
+
+from odoo.tests.common import TransactionCase
+
+
+class TestSiteImport(TransactionCase):
+
+    def _create_job(self, lines, batch_size=2):
+        content = '\n'.join(lines).encode('utf-8')
+        return self.env['site.import.job'].create({
+            'name': 'Import Test',
+            'file': base64.b64encode(content),
+            'file_name': 'sites.csv',
+            'batch_size': batch_size,
+        })
+
+    def test_import_reports_rejected_rows(self):
+        """Las filas inválidas se rechazan con su motivo sin abortar el resto del fichero."""
+        partner = self.env['res.partner'].create({'name': 'ACME Import'})
+        job = self._create_job([
+            'name,budget,project_size,deadline_date,partner_id',
+            'Site Import 1,100.5,small,2030-01-01 00:00:00,ACME Import',
+            'Site Import 2,abc,small,,',
+            'Site Import 3,,huge,,',
+            'Site Import 4,20,large,,%s' % partner.id,
+            'Site Import 5,10',
+            'Site Import 6,,,,Nobody Import',
+        ])
+        self.assertTrue(job._run())
+
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.rows_done, 6)
+        self.assertEqual(job.created_count, 2)
+        self.assertEqual(job.rejected_count, 4)
+        self.assertEqual(job.rejection_ids.mapped('row_number'), [3, 4, 6, 7])
+
+        sites = self.env['project.project'].search([('name', 'like', 'Site Import %')], order='name')
+        self.assertEqual(sites.mapped('name'), ['Site Import 1', 'Site Import 4'])
+        self.assertEqual(sites.mapped('partner_id'), partner)
+        self.assertEqual(sites[0].budget, 100.5)
+
+    def test_import_resumes_after_processed_rows(self):
+        """Un job interrumpido continúa después de las filas ya procesadas."""
+        job = self._create_job(['name', 'Site Resume 1', 'Site Resume 2', 'Site Resume 3'])
+        job.rows_done = 2
+        job._run()
+        sites = self.env['project.project'].search([('name', 'like', 'Site Resume %')])
+        self.assertEqual(sites.mapped('name'), ['Site Resume 3'])
+
+    def test_import_rejects_rows_blocked_by_milestone(self):
+        """Sólo se rechazan las filas cuyo milestone exige campos que no traen, con el mensaje de la línea."""
+        milestones = self.env['project.project'].create({'name': 'Import Milestones'})
+        stage = self.env['project.task'].create({'name': 'Import Stage', 'project_id': milestones.id})
+        partner_field = self.env['ir.model.fields'].search([('model', '=', 'project.project'), ('name', '=', 'partner_id')])
+        requirement = self.env['dynamic.requirement.field'].create({'name': 'Req Import', 'type': 'site'})
+        self.env['dynamic.requirement.field.line'].create({
+            'requirement_id': requirement.id,
+            'stage_id': stage.id,
+            'mandatory_fields': [(6, 0, partner_field.ids)],
+            'custom_warning_msg': 'Customer is mandatory for this stage',
+        })
+        partner = self.env['res.partner'].create({'name': 'ACME Stage Import'})
+        job = self._create_job([
+            'name,requirement_id,stage_site_id,partner_id',
+            'Site Stage 1,%s,%s,%s' % (requirement.id, stage.id, partner.id),
+            'Site Stage 2,%s,%s,' % (requirement.id, stage.id),
+            'Site Stage 3,%s,,' % requirement.id,
+            'Site Stage 4,%s,%s,%s' % (requirement.id, stage.id, partner.id),
+            'Site Stage 5,%s,%s,' % (requirement.id, stage.id),
+        ], batch_size=10)
+        self.assertTrue(job._run())
+
+        self.assertEqual(job.created_count, 3)
+        self.assertEqual(job.rejection_ids.mapped('row_number'), [3, 6])
+        self.assertEqual(set(job.rejection_ids.mapped('reason')), {'Customer is mandatory for this stage'})
+        sites = self.env['project.project'].search([('name', 'like', 'Site Stage %')], order='name')
+        self.assertEqual(sites.mapped('name'), ['Site Stage 1', 'Site Stage 3', 'Site Stage 4'])
+        self.assertEqual(sites.filtered('stage_site_id').mapped('partner_id'), partner)
+
+    def test_import_fails_on_unexpected_errors(self):
+        """Un error que no viene de los datos de la fila no se convierte en rechazo: falla el lote."""
+        job = self._create_job(['name', 'Site Error 1'])
+        Project = self.env['project.project']
+        with patch.object(type(Project), 'create', side_effect=KeyError('programming error')):
+            with self.assertRaises(KeyError):
+                job._import_batch(['name'], job._get_converters(['name']), [(2, ['Site Error 1'])])